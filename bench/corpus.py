@@ -0,0 +1,104 @@
+"""
+Synthetic image corpus for benchmarks.
+
+Files are random bytes with image extensions, which is all hashing, lookups and file operations look at.
+With Pillow installed, --real writes noise JPEGs instead so thumbnails and perceptual hashes can be measured too.
+
+    python bench/corpus.py /tmp/corpus --count 5000
+"""
+import argparse
+import hashlib
+import io
+import os
+import random
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# (share of files, smallest, largest size in bytes)
+SIZES = (
+    (0.60, 50 * 1024, 300 * 1024),
+    (0.35, 300 * 1024, 2 * 1024 * 1024),
+    (0.05, 2 * 1024 * 1024, 8 * 1024 * 1024),
+)
+EXTENSIONS = ('.jpg', '.png', '.gif', '.webp')
+
+
+def random_size(rng: random.Random) -> int:
+    roll = rng.random()
+    for share, smallest, largest in SIZES:
+        if roll < share:
+            return rng.randint(smallest, largest)
+        roll -= share
+    return SIZES[-1][2]
+
+
+def noise_jpeg(rng: random.Random) -> bytes:
+    width, height = rng.randint(400, 2000), rng.randint(400, 2000)
+    image = Image.frombytes('RGB', (width // 8, height // 8), rng.randbytes(width // 8 * (height // 8) * 3))
+    output = io.BytesIO()
+    image.resize((width, height)).save(output, 'JPEG', quality=85)
+    return output.getvalue()
+
+
+def generate(directory: str, count: int, seed: int = 0, named: float = 0.3, duplicates: float = 0.05,
+             nested: float = 0.1, real: bool = False) -> int:
+    """
+    Write count files to directory. Returns the total number of bytes written.
+
+    named is the share of files named after their md5, as booru downloads are, duplicates the share that are
+    byte-identical copies of an earlier file, and nested the share placed in sub-folders.
+    """
+    if real and Image is None:
+        raise RuntimeError('Pillow is needed for real images')
+
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    total = 0
+
+    for n in range(count):
+        if written and rng.random() < duplicates:
+            data = rng.choice(written)
+        else:
+            data = noise_jpeg(rng) if real else rng.randbytes(random_size(rng))
+
+        md5 = hashlib.md5(data).hexdigest()
+        extension = '.jpg' if real else rng.choice(EXTENSIONS)
+        name = (md5 if rng.random() < named else f'image_{n:07}') + extension
+        if name.startswith(md5) and os.path.exists(os.path.join(directory, name)):
+            name = f'image_{n:07}{extension}'
+
+        folder = directory
+        if rng.random() < nested:
+            folder = os.path.join(directory, f'folder_{rng.randint(0, 9)}', f'sub_{rng.randint(0, 3)}')
+            os.makedirs(folder, exist_ok=True)
+
+        with open(os.path.join(folder, name), 'wb') as file_:
+            file_.write(data)
+        total += len(data)
+
+        # A bounded sample keeps duplicates possible without holding the whole corpus in memory
+        if len(written) < 64:
+            written.append(data)
+        elif rng.random() < 0.05:
+            written[rng.randrange(64)] = data
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic image corpus.')
+    parser.add_argument('directory')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--named', type=float, default=0.3, help='Share of files named after their md5')
+    parser.add_argument('--duplicates', type=float, default=0.05, help='Share of byte-identical copies')
+    parser.add_argument('--nested', type=float, default=0.1, help='Share of files placed in sub-folders')
+    parser.add_argument('--real', action='store_true', help='Write noise JPEGs, needs Pillow')
+    args = parser.parse_args()
+
+    size = generate(args.directory, args.count, args.seed, args.named, args.duplicates, args.nested, args.real)
+    print(f'Wrote {args.count} files, {size / 1024 ** 2:.1f} MiB, to {args.directory}')
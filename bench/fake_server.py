@@ -0,0 +1,241 @@
+"""
+Local stand-in for the Danbooru, Gelbooru, Yande.re, SauceNao, Imgur and NoLife endpoints, so throughput can be
+measured without spending real API quota. Latency, error rates and rate limits are configurable.
+
+    python bench/fake_server.py --port 8700 --latency 80 --error-rate 0.01 --rate-limit 10
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+
+class FakeState:
+    def __init__(self, latency: float = 50.0, jitter: float = 0.5, error_rate: float = 0.0, rate_limit: float = 0.0,
+                 retry_after: int = 1, hit_rate: float = 0.7, sauce_hit_rate: float = 0.5, sauce_daily: int = 300,
+                 tail_rate: float = 0.0):
+        # Milliseconds, each response waits latency * (1 +- jitter)
+        self.latency = latency
+        self.jitter = jitter
+        # Share of responses that take ten times as long
+        self.tail_rate = tail_rate
+        self.error_rate = error_rate
+        # Requests per second per endpoint before answering 429, 0 for no limit
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        # Share of md5s each booru knows, and of reverse searches that find a post
+        self.hit_rate = hit_rate
+        self.sauce_hit_rate = sauce_hit_rate
+        self.sauce_daily = sauce_daily
+        self.sauce_remaining = sauce_daily
+
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.counts = {}
+        self.uploads = 0
+        self.bytes_received = 0
+
+    @staticmethod
+    def fraction(key: str) -> float:
+        # Stable per key, so repeated runs see the same answers
+        return int(hashlib.md5(key.encode()).hexdigest()[:8], 16) / 2 ** 32
+
+    def post(self, md5: str, id_: int = None) -> dict:
+        n = int(md5[:6], 16)
+        characters = [f'character_{n % 97}'] + ([f'character_{n % 89}'] if n % 3 == 0 else [])
+        copyrights = [f'series_{n % 31}'] + ([f'series_{n % 29}'] if n % 4 == 0 else [])
+        return {
+            'id': id_ if id_ is not None else n,
+            'md5': md5,
+            'tag_string_character': ' '.join(characters),
+            'tag_count_character': len(characters),
+            'tag_string_copyright': ' '.join(copyrights),
+            'tag_count_copyright': len(copyrights),
+            'rating': 's' if n % 2 else 'q',
+            'tag_string_general': ' '.join(f'tag_{n % i}' for i in range(2, 40)),
+            'file_url': f'https://example.invalid/{md5}.jpg',
+        }
+
+    def tagged_post(self, md5: str, id_: int = None) -> dict:
+        # Gelbooru and Yande.re answer with a single tag string
+        post = self.post(md5, id_)
+        tags = ' '.join((post['tag_string_character'], post['tag_string_copyright'], post['tag_string_general']))
+        rating = 'safe' if post['rating'] == 's' else 'questionable'
+        return {'id': post['id'], 'md5': md5, 'tags': tags, 'rating': rating}
+
+    @staticmethod
+    def tag_type(name: str) -> int:
+        return 4 if name.startswith('character_') else 3 if name.startswith('series_') else 0
+
+    def limited(self, endpoint: str) -> bool:
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            if not self.rate_limit:
+                return False
+
+            second = int(time.time())
+            start, count = self.windows.get(endpoint, (second, 0))
+            if start != second:
+                start, count = second, 0
+            self.windows[endpoint] = start, count + 1
+            return count >= self.rate_limit
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body, headers: dict = None) -> None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Content-Type', 'application/json')
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self) -> None:
+        state = self.state
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+            with state.lock:
+                state.bytes_received += length
+
+        delay = state.latency * (1 + random.uniform(-state.jitter, state.jitter)) / 1000
+        if random.random() < state.tail_rate:
+            delay *= 10
+        time.sleep(max(0.0, delay))
+
+        endpoint = '/posts/{id}.json' if url.path.startswith('/posts/') else url.path
+        if state.limited(endpoint):
+            return self.reply(429, {'error': 'rate limited'}, {'Retry-After': state.retry_after})
+        if random.random() < state.error_rate:
+            return self.reply(503, {'error': 'unavailable'})
+
+        # Danbooru leaves out every field not listed in only=
+        only = query['only'].split(',') if query.get('only') else None
+
+        def project(post):
+            return {k: v for k, v in post.items() if k in only} if only else post
+
+        if url.path == '/posts.json':
+            tags = query.get('tags', '')
+            md5s = tags[4:].split(',') if tags.startswith('md5:') else []
+            return self.reply(200, [project(state.post(i)) for i in md5s if state.fraction(i) < state.hit_rate])
+
+        if url.path.startswith('/posts/'):
+            id_ = int(url.path[len('/posts/'):].split('.')[0])
+            return self.reply(200, project(state.post(hashlib.md5(str(id_).encode()).hexdigest(), id_)))
+
+        # Gelbooru and Yande.re know their own, partly different, share of md5s
+        def tagged(tags, site):
+            if tags.startswith('md5:'):
+                md5 = tags[4:]
+                return [state.tagged_post(md5)] if state.fraction(md5 + site) < state.hit_rate else []
+            if tags.startswith('id:'):
+                id_ = int(tags[3:])
+                return [state.tagged_post(hashlib.md5(str(id_).encode()).hexdigest(), id_)]
+            return []
+
+        if url.path == '/index.php' and query.get('s') == 'post':
+            posts = tagged(f'id:{query["id"]}' if query.get('id') else query.get('tags', ''), 'gelbooru')
+            return self.reply(200, {'@attributes': {'count': len(posts)}, 'post': posts})
+
+        if url.path == '/index.php' and query.get('s') == 'tag':
+            tags = [{'name': i, 'type': state.tag_type(i)} for i in query.get('names', '').split()]
+            return self.reply(200, {'@attributes': {'count': len(tags)}, 'tag': tags})
+
+        if url.path == '/post.json':
+            return self.reply(200, tagged(query.get('tags', ''), 'yandere'))
+
+        if url.path == '/tag.json':
+            name = query.get('name', '')
+            return self.reply(200, [{'name': name, 'type': state.tag_type(name)}])
+
+        if url.path == '/search.php':
+            with state.lock:
+                state.sauce_remaining -= 1
+                remaining = state.sauce_remaining
+            if remaining < 0:
+                header = {'status': -2, 'short_remaining': 20, 'long_remaining': 0,
+                          'long_limit': state.sauce_daily, 'message': 'Daily Search Limit Exceeded.'}
+                return self.reply(429, {'header': header})
+            key = query.get('url') or f'{time.time()}{random.random()}'
+            results = []
+            if state.fraction(key) < state.sauce_hit_rate:
+                data = {'danbooru_id': int(state.fraction(key + 'id') * 10 ** 7)}
+                # Results from booru indexes carry the tags too, pixiv-style ones only ids
+                if state.fraction(key + 'tags') < 0.5:
+                    n = int(state.fraction(key + 'n') * 10 ** 6)
+                    data.update(characters=f'character {n % 97}', material=f'series {n % 31}')
+                results.append({'header': {'similarity': '95.5'}, 'data': data})
+            results.append({'header': {'similarity': '42.0'}, 'data': {'pixiv_id': 1, 'danbooru_id': 1}})
+            header = {'short_remaining': 20, 'long_remaining': remaining, 'long_limit': state.sauce_daily}
+            return self.reply(200, {'header': header, 'results': results})
+
+        if url.path == '/3/upload':
+            with state.lock:
+                state.uploads += 1
+                n = state.uploads
+            headers = {'X-RateLimit-UserRemaining': 500, 'X-RateLimit-ClientRemaining': 12500,
+                       'X-Post-Rate-Limit-Remaining': 1250, 'X-Post-Rate-Limit-Reset': 3600}
+            return self.reply(200, {'data': {'link': f'https://i.example.invalid/{n}.jpg'}}, headers)
+
+        if url.path == '/upload.php':
+            with state.lock:
+                state.uploads += 1
+                n = state.uploads
+            return self.reply(200, f'https://nolife.example.invalid/{n}.jpg'.encode())
+
+        self.reply(404, {'error': 'not found'})
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+
+def serve(port: int = 0, **options) -> tuple:
+    """
+    Start the server on a background thread. Returns (server, state), server.server_address has the port.
+    """
+    handler = type('BoundHandler', (Handler,), {'state': FakeState(**options)})
+    server = http.server.ThreadingHTTPServer(('0.0.0.0', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler.state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Danbooru/Gelbooru/Yande.re/SauceNao/Imgur/NoLife server.')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--latency', type=float, default=50.0, help='Mean response latency in ms')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Latency varies by this fraction either way')
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='Share of responses ten times slower than usual')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Requests per second per endpoint before 429s')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent with 429s')
+    parser.add_argument('--hit-rate', type=float, default=0.7, help='Share of md5s found on each fake booru')
+    args = parser.parse_args()
+
+    server, _ = serve(args.port, latency=args.latency, jitter=args.jitter, tail_rate=args.tail_rate,
+                      error_rate=args.error_rate,
+                      rate_limit=args.rate_limit, retry_after=args.retry_after, hit_rate=args.hit_rate)
+    print(f'Serving on port {server.server_address[1]}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
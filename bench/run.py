@@ -0,0 +1,205 @@
+"""
+End-to-end benchmark against the local fake server.
+
+Every combination of the given --md5, --multiple and --file-op options sorts a fresh copy of a synthetic corpus in
+its own process and working directory, so caches, checkpoints and peak memory never carry over between runs.
+Reports images/sec, latency percentiles per pipeline stage and peak RSS, and writes them as JSON to --output.
+
+    python bench/run.py --count 2000 --latency 80 --md5 hard soft --file-op copy move hardlink
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, BENCH)
+
+import corpus
+import fake_server
+
+# Each real host is stood in for by its own loopback address, so the rate limiter still keeps a bucket per host
+HOSTS = {
+    'danbooru.donmai.us': '127.0.0.2',
+    'saucenao.com': '127.0.0.3',
+    'api.imgur.com': '127.0.0.4',
+    'botter.doesnt-have-a.life': '127.0.0.5',
+    'safebooru.donmai.us': '127.0.0.6',
+    'gelbooru.com': '127.0.0.7',
+    'yande.re': '127.0.0.8',
+}
+KEY_FILES = ('sauceNaoApiKey.txt', 'imgurApiKey.txt', 'noLifeKey.txt')
+
+
+def redirect(url: str, port: int) -> str:
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit(('http', f'{HOSTS[parts.hostname]}:{port}', parts.path, parts.query, ''))
+
+
+def child(port: int, result_path: str, unlimited: bool, program_args: list) -> None:
+    """
+    Runs inside the benchmark process: points every service at the fake server, sorts, then writes the results.
+    """
+    sys.path.insert(0, ROOT)
+    import main
+    from services import metrics
+    from services.booru import Booru
+    from services.rate_limit import RateLimiter
+    from services.sauce_nao import SauceNao
+    from services.uploaders import Imgur, NoLife
+
+    for provider in Booru.PROVIDERS.values():
+        # Only the endpoints each booru declares itself, inherited ones were already redirected
+        for name, value in list(vars(provider).items()):
+            if name.startswith('ENDPOINT'):
+                setattr(provider, name, redirect(value, port))
+    SauceNao.ENDPOINT = redirect(SauceNao.ENDPOINT, port)
+    Imgur.ENDPOINT = redirect(Imgur.ENDPOINT, port)
+    NoLife.ENDPOINT = redirect(NoLife.ENDPOINT, port)
+    RateLimiter.LIMITS = {} if unlimited else {HOSTS[host]: limits for host, limits in RateLimiter.LIMITS.items()}
+
+    sys.argv = ['main.py'] + program_args
+    start = time.perf_counter()
+    program = main.Program()
+    elapsed = time.perf_counter() - start
+
+    stages = {}
+    for (name, labels), histogram in metrics.shared().histograms.items():
+        if name == 'stage_seconds':
+            # Percentiles are estimated from the histogram buckets
+            stages[dict(labels)['stage']] = {
+                'count': histogram.count, 'p50': histogram.quantile(0.5) * 1000,
+                'p90': histogram.quantile(0.9) * 1000, 'p99': histogram.quantile(0.99) * 1000,
+                'max': histogram.max * 1000,
+            }
+
+    with open(result_path, 'w') as file_:
+        json.dump({
+            'elapsed': elapsed,
+            'images': program.found,
+            'stages': stages,
+            'counters': metrics.shared().summary()['counters'],
+            # Linux reports kilobytes, the hashing processes are counted separately
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }, file_)
+
+
+def run(corpus_dir: str, port: int, state, args, md5: str, multiple: str, file_op: str) -> dict:
+    work = tempfile.mkdtemp(prefix='bench-')
+    try:
+        shutil.copytree(corpus_dir, os.path.join(work, 'images'))
+        os.makedirs(os.path.join(work, 'keys'))
+        for name in KEY_FILES:
+            with open(os.path.join(work, 'keys', name), 'w') as file_:
+                file_.write('benchmark')
+
+        program_args = ['--dir', 'images', '--sort-by', args.sort_by, '--md5', md5, '--multiple', multiple,
+                        '--file-op', file_op, '--depth', '-1', '--do-reverse', 'true' if args.reverse else 'false',
+                        '--host', args.host, '--phash-threshold', str(args.phash_threshold)] + args.extra
+        result_path = os.path.join(work, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--child', str(port), result_path]
+        if args.unlimited:
+            command.append('--unlimited')
+        command += ['--'] + program_args
+
+        state.counts.clear()
+        with open(os.path.join(work, 'output.log'), 'w') as output:
+            returncode = subprocess.call(command, cwd=work, stdout=output, stderr=subprocess.STDOUT)
+        if returncode or not os.path.exists(result_path):
+            with open(os.path.join(work, 'output.log')) as output:
+                sys.stderr.write(output.read()[-4000:])
+            raise RuntimeError(f'Benchmark run failed with exit code {returncode}')
+
+        with open(result_path) as file_:
+            result = json.load(file_)
+        result.update(md5=md5, multiple=multiple, file_op=file_op, requests=dict(state.counts),
+                      images_per_sec=result['images'] / result['elapsed'] if result['elapsed'] else 0.0)
+        return result
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def report(result: dict) -> None:
+    print(f"\n{result['md5']} md5, {result['multiple']}, {result['file_op']}: {result['images']} images in "
+          f"{result['elapsed']:.2f}s, {result['images_per_sec']:.1f} images/sec, peak RSS "
+          f"{result['peak_rss_kb'] / 1024:.1f} MiB (hash workers {result['children_peak_rss_kb'] / 1024:.1f} MiB)")
+    print(f"  {'stage':<20}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stage in result['stages'].items():
+        if stage['count']:
+            print(f"  {name:<20}{stage['count']:>8}{stage['p50']:>10.2f}{stage['p90']:>10.2f}"
+                  f"{stage['p99']:>10.2f}{stage['max']:>10.2f}")
+    print(f"  requests: {', '.join(f'{k} {v}' for k, v in sorted(result['requests'].items())) or 'none'}")
+    sleep = sum(result['counters'].get('rate_limit_sleep_seconds_total', {}).values())
+    retries = sum(result['counters'].get('http_retries_total', {}).values())
+    print(f"  {sleep:.1f}s waiting on rate limits, {retries:.0f} retries")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark sorting against a local fake Danbooru and SauceNao.')
+    parser.add_argument('--corpus', help='Corpus directory, generated if missing (defaults to a temporary one)')
+    parser.add_argument('--count', type=int, default=1000, help='Images in a generated corpus')
+    parser.add_argument('--real', action='store_true', help='Generate real JPEGs, needs Pillow')
+    parser.add_argument('--md5', nargs='+', default=['hard', 'soft'])
+    parser.add_argument('--multiple', nargs='+', default=['copies', 'first'])
+    parser.add_argument('--file-op', nargs='+', default=['copy', 'move', 'hardlink'])
+    parser.add_argument('--sort-by', default='both')
+    parser.add_argument('--reverse', action='store_true', help='Reverse search images Danbooru does not know')
+    parser.add_argument('--host', default='imgur', help='Image host used with --reverse')
+    parser.add_argument('--phash-threshold', type=int, default=-1)
+    parser.add_argument('--unlimited', action='store_true', help='Drop the client-side rate limits')
+    parser.add_argument('--latency', type=float, default=50.0, help='Mean fake server latency in ms')
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='Share of responses ten times slower than usual')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Server-side requests per second before 429s')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--hit-rate', type=float, default=0.7)
+    parser.add_argument('--sauce-daily', type=int, default=300, help='Daily searches the fake SauceNao allows')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('extra', nargs='*', help='Further options passed on to main.py, after --')
+    args = parser.parse_args()
+
+    temporary = None
+    corpus_dir = args.corpus
+    if corpus_dir is None:
+        temporary = corpus_dir = tempfile.mkdtemp(prefix='bench-corpus-')
+    if not os.path.isdir(corpus_dir) or not os.listdir(corpus_dir):
+        size = corpus.generate(corpus_dir, args.count, real=args.real)
+        print(f'Generated {args.count} files, {size / 1024 ** 2:.1f} MiB')
+
+    server, state = fake_server.serve(latency=args.latency, jitter=args.jitter, tail_rate=args.tail_rate,
+                                      error_rate=args.error_rate,
+                                      rate_limit=args.rate_limit, retry_after=args.retry_after,
+                                      hit_rate=args.hit_rate, sauce_daily=args.sauce_daily)
+    port = server.server_address[1]
+
+    results = []
+    try:
+        for md5, multiple, file_op in itertools.product(args.md5, args.multiple, args.file_op):
+            results.append(run(corpus_dir, port, state, args, md5, multiple, file_op))
+            report(results[-1])
+    finally:
+        server.shutdown()
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    with open(args.output, 'w') as file_:
+        json.dump(results, file_, indent=2)
+    print(f'\nResults written to {args.output}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        separator = sys.argv.index('--')
+        child(int(sys.argv[2]), sys.argv[3], '--unlimited' in sys.argv[4:separator], sys.argv[separator + 1:])
+    else:
+        main()
@@ -1,15 +1,36 @@
 ﻿import argparse
-import hashlib
+import concurrent.futures
+import glob
 import time
 import sys
 import os
 import re
+import threading
 
-from shutil import copyfile
-
+from services import session as http
 from services.booru import Booru, BImage
-from services.sauce_nao import SauceNao
+from services.booru_cache import BooruCache
+from services.checkpoint import Checkpoint
+from services.database import Database
+from services.dump_index import DumpIndex
+from services import file_ops
+from services import metrics
+from services.file_ops import FileOperations, Op
+from services.hash_cache import HashCache
+from services.hashing import Hasher, ignore_interrupts, md5_file
+from services.manifest import Manifest
+from services.near_duplicates import NearDuplicateIndex
+from services.pipeline import Pipeline, Stage
+from services.post import Post
+from services.rate_limit import RateLimitExceeded
+from services.scanner import OutputFolders, scan
+from services.search_queue import Quota, SearchQueue
+from services.single_flight import SingleFlight
+from services.unknown import UnknownJournal
+from services.watcher import Watcher
+from services.sauce_nao import SauceNao, SauceNaoResolver
 from services.uploaders import NoLife, Imgur
+from services import imaging
 
 from services.prompts import *
 
@@ -21,6 +42,8 @@ class Program:
 
     MOVE = 'Move'
     COPY = 'Copy'
+    HARDLINK = 'Hardlink'
+    REFLINK = 'Reflink'
 
     HARD = 'Hard'
     SOFT = 'Soft'
@@ -30,6 +53,7 @@ class Program:
     FIRST = 'First'
     SKIP = 'Skip'
 
+    DIRECT = 'Direct'
     IMGUR = 'Imgur'
     NOLIFE = 'NoLife'
 
@@ -38,138 +62,585 @@ class Program:
 
     def __init__(self):
         self.multiple_operation = None
-        self.base_directory = None
+        self.base_directories = None
         self.file_operation = None
         self.do_reverse_image = None
         self.image_host = None
+        self.fallback_host = None
+        self.direct_search = False
+        self.thumbnail_pool = None
         self.md5_option = None
         self.sort_by = None
+        self.hash_workers = None
+        self.batch_size = None
+        self.lookup_workers = None
+        self.search_workers = None
+        self.file_workers = None
+        self.dry_run = None
+        self.depth = None
+        self.phash_workers = None
+        self.quiet = None
+        self.metrics_path = None
+        self.metrics_interval = None
+        self.resorting = None
+        self.watching = None
+        self.settle = None
+        self.poll_interval = None
+        self.boorus = None
+        self.sauce_priority = None
+        self.draining = None
 
         parser = argparse.ArgumentParser(description='Sort large amount of anime pictures.')
-        parser.add_argument('--dir', default=[None], nargs=1, help='Where to search for images')
+        parser.add_argument('--dir', nargs='+', help='Where to search for images, any number of directories or globs')
         parser.add_argument('--sort-by', default=[None], nargs=1, help='What to group images by')
         parser.add_argument('--file-op', default=[None], nargs=1, help='How to process files')
+        parser.add_argument('--dry-run', action='store_true', help='Print the planned file operations instead')
+        parser.add_argument('--quiet', action='store_true', help='Show a progress line instead of every file')
+        parser.add_argument('--metrics', default=[None], nargs=1, metavar='PATH',
+                            help='Write run metrics to PATH, as JSON if it ends in .json, otherwise for Prometheus')
+        parser.add_argument('--metrics-interval', default=[30.0], nargs=1, type=float,
+                            help='Seconds between metrics writes during a run')
         parser.add_argument('--md5', default=[None], nargs=1, help='MD5 calculation process')
         parser.add_argument('--multiple', default=[None], nargs=1, help='How to handle multiple tags')
         parser.add_argument('--do-reverse', default=[None], nargs=1, help='Whether to reverse image search')
         parser.add_argument('--host', default=[None], nargs=1, help='Where to upload images')
+        parser.add_argument('--fallback-host', default=[None], nargs=1,
+                            help='Where to upload images when a direct thumbnail search fails')
+        parser.add_argument('--sauce-priority', default=['newest'], nargs=1, choices=SearchQueue.PRIORITIES,
+                            help='Which queued images are reverse searched first while SauceNao quota is short')
+        parser.add_argument('--drain-searches', action='store_true',
+                            help='Reverse search the queued images as SauceNao quota frees up, without scanning, '
+                                 'until none are left')
+        parser.add_argument('--depth', default=[0], nargs=1, type=int,
+                            help='How many levels of sub-folders to search for images, -1 for all')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep running and sort new images as they arrive, until interrupted')
+        parser.add_argument('--settle', default=[1.0], nargs=1, type=float,
+                            help='Seconds a new file has to stay unchanged before it is sorted in watch mode')
+        parser.add_argument('--poll-interval', default=[2.0], nargs=1, type=float,
+                            help='Seconds between listings in watch mode where inotify is not available')
+        parser.add_argument('--hash-workers', default=[None], nargs=1, type=int,
+                            help='Number of processes used to hash files (defaults to the number of cores)')
+        parser.add_argument('--boorus', default=['danbooru', 'safebooru'], nargs='+', choices=sorted(Booru.PROVIDERS),
+                            help='Boorus images are looked up on, in order. Later ones are asked when earlier ones '
+                                 'are slow or have no post, safebooru only ever when danbooru is slow')
+        parser.add_argument('--batch-size', default=[Booru.BATCH_SIZE], nargs=1, type=int,
+                            help='Number of hashes looked up on Danbooru per request')
+        parser.add_argument('--lookup-workers', default=[2], nargs=1, type=int,
+                            help='Danbooru lookups running at the same time')
+        parser.add_argument('--search-workers', default=[2], nargs=1, type=int,
+                            help='Reverse image searches running at the same time')
+        parser.add_argument('--file-workers', default=[4], nargs=1, type=int,
+                            help='Files copied, linked or moved at the same time')
+        parser.add_argument('--phash-threshold', default=[4], nargs=1, type=int,
+                            help='Most differing bits for an image to count as a near-duplicate of an identified one, '
+                                 '-1 to disable')
+        parser.add_argument('--negative-ttl', default=[7.0], nargs=1, type=float,
+                            help='Days before an image that was not found on Danbooru is looked up again')
+        parser.add_argument('--cache-size', default=[1_000_000], nargs=1, type=int,
+                            help='Most Danbooru answers kept in the local cache')
+        parser.add_argument('--offline', action='store_true',
+                            help='Only use cached Danbooru answers, make no network requests')
+        parser.add_argument('--pool-size', default=[10], nargs=1, type=int,
+                            help='Keep-alive connections kept open per host')
+        parser.add_argument('--max-retry-wait', default=[600.0], nargs=1, type=float,
+                            help='Most seconds spent backing off before a request is given up')
+        parser.add_argument('--import-dump', nargs='+', metavar='JSONL',
+                            help='Add Danbooru posts from JSONL dumps to the offline index, then exit')
+        parser.add_argument('--compact-index', action='store_true',
+                            help='Merge the offline index into a single file, then exit')
+        parser.add_argument('--prune-hash-cache', action='store_true',
+                            help='Remove cached hashes of files that were deleted or changed, then exit')
+        parser.add_argument('--resort', action='store_true',
+                            help='Lay already sorted images out again under the current settings, without hashing '
+                                 'or network requests')
         args = parser.parse_args(sys.argv[1:])
 
         self.multiple_operation = {'copies': self.COPIES, 'mixed': self.MIXED, 'first': self.FIRST, 'skip': self.SKIP}.get(args.multiple[0])
         self.sort_by = {'series': self.SERIES, 'character': self.CHARACTER, 'both': self.BOTH}.get(args.sort_by[0])
-        self.file_operation = {'move': self.MOVE, 'copy': self.COPY}.get(args.file_op[0])
-        self.image_host = {'imgur': self.IMGUR, 'nolife': self.NOLIFE}.get(args.host[0])
+        self.file_operation = {'move': self.MOVE, 'copy': self.COPY, 'hardlink': self.HARDLINK,
+                               'reflink': self.REFLINK}.get(args.file_op[0])
+        self.image_host = {'direct': self.DIRECT, 'imgur': self.IMGUR, 'nolife': self.NOLIFE}.get(args.host[0])
+        self.fallback_host = {'imgur': self.IMGUR, 'nolife': self.NOLIFE}.get(args.fallback_host[0])
         self.do_reverse_image = {'true': True, 'false': False}.get(args.do_reverse[0])
         self.md5_option = {'hard': self.HARD, 'soft': self.SOFT}.get(args.md5[0])
-        self.base_directory = args.dir[0]
+        if args.dir:
+            self.base_directories = self.expand_directories(args.dir)
+        self.depth = args.depth[0]
+        self.hash_workers = args.hash_workers[0]
+        self.batch_size = max(1, min(args.batch_size[0], Booru.BATCH_SIZE))
+        self.boorus = args.boorus
+        self.lookup_workers = args.lookup_workers[0]
+        self.search_workers = args.search_workers[0]
+        self.file_workers = args.file_workers[0]
+        self.dry_run = args.dry_run
+        self.quiet = args.quiet
+        self.metrics_path = args.metrics[0]
+        self.metrics_interval = args.metrics_interval[0]
+        self.resorting = args.resort
+        self.watching = args.watch
+        self.settle = args.settle[0]
+        self.poll_interval = args.poll_interval[0]
+        self.sauce_priority = args.sauce_priority[0]
+        self.draining = args.drain_searches
+        if self.draining:
+            self.do_reverse_image = True
+        self.phash_workers = os.cpu_count() or 1
+        self.offline = args.offline
+        if self.offline:
+            self.do_reverse_image = False
+
+        http.configure(pool_size=args.pool_size[0], max_wait=args.max_retry_wait[0])
+
+        self.database = Database()
+        self.hash_cache = HashCache(self.database)
+        self.booru_cache = BooruCache(self.database, negative_ttl=args.negative_ttl[0] * 24 * 3600,
+                                      max_entries=args.cache_size[0])
+        if args.prune_hash_cache:
+            print(f'{MAJOR_PROMPT}Pruned {self.hash_cache.prune()} stale hashes.')
+            return
 
-        self.unknown = []
-        if os.path.exists('unknown.txt'):
-            with open('unknown.txt') as file_:
-                self.unknown = file_.read().split('\n')
+        self.dump_index = DumpIndex()
+        if args.import_dump or args.compact_index:
+            for path in args.import_dump or []:
+                print(f'{MAJOR_PROMPT}Imported {self.dump_index.import_dump(path)} posts from {path}.')
+            if args.compact_index:
+                print(f'{MAJOR_PROMPT}Compacted index holds {self.dump_index.compact()} posts.')
+            return
+
+        self.output_folders = OutputFolders(self.database)
+        self.manifest = Manifest(self.database)
+        # Target paths of operations still running, with the md5 of the image going there
+        self.claims = {}
+        self.claims_lock = threading.Lock()
+        self.near_duplicates = None
+        if args.phash_threshold[0] >= 0:
+            if imaging.available():
+                self.near_duplicates = NearDuplicateIndex(self.database, args.phash_threshold[0])
+            else:
+                print(f'{ERROR_PROMPT}Install numpy and Pillow to match near-duplicates of identified images.')
+        # Misses are looked up again once they are as old as cached misses
+        self.unknown = UnknownJournal(ttl=args.negative_ttl[0] * 24 * 3600)
+        self.quota = Quota(self.database)
+        self.search_queue = SearchQueue(self.database, self.sauce_priority)
+        if self.draining and self.base_directories is None:
+            # Every directory images were queued from
+            self.base_directories = [i for i in self.search_queue.roots() if os.path.isdir(i)]
+            if not self.base_directories:
+                print(f'{MAJOR_PROMPT}No images are waiting for a reverse search.')
+                return
 
         if not self.get_settings():
             return
 
+        if self.resorting:
+            self.resort()
+            return
+
         if self.do_reverse_image:
-            self.sauce_nao = SauceNao()
+            self.sauce_nao = SauceNao(quota=self.quota)
+
+            if self.image_host == self.DIRECT:
+                if not imaging.available():
+                    print(f'{ERROR_PROMPT}Direct thumbnail search needs numpy and Pillow installed.')
+                self.direct_search = imaging.available()
+                self.image_host = self.fallback_host
+                # Thumbnails are made in their own processes, the search workers only wait on them
+                self.thumbnail_pool = concurrent.futures.ProcessPoolExecutor(self.search_workers,
+                                                                             initializer=ignore_interrupts)
 
             if self.image_host == self.IMGUR:
                 self.image_host = Imgur()
             elif self.image_host == self.NOLIFE:
                 self.image_host = NoLife()
-            else:
+            elif self.image_host is not None or not self.direct_search:
                 print(f'{ERROR_PROMPT}Unknown image host. Aborting.')
                 return
 
-        # List all files in the current folder
-        files = [
-            i for i in os.listdir(self.base_directory)
-            if i[-4:].lower() in ['.jpg', '.png', '.gif']
-        ]
-        print(f'{MAJOR_PROMPT}Found {len(files)} images.')
+        # Draining scans nothing, so it has nothing to resume and must leave a scan's checkpoint alone
+        self.checkpoint = Checkpoint(self.base_directories, enabled=not self.dry_run and not self.draining)
+        if self.checkpoint.done and not self.draining:
+            print(f'{MAJOR_PROMPT}Resuming, {len(self.checkpoint.done)} of {len(self.base_directories)} '
+                  f'directories were already finished.')
+
+        self.found = 0
+        self.skipped = 0
+        self.booru = Booru(self.booru_cache, self.offline, index=self.dump_index, providers=self.boorus)
+        self.resolver = SauceNaoResolver(self.booru.id_lookups())
+        # Identical images share one lookup and one search, and are placed as links to the first one placed
+        self.lookups = SingleFlight('lookup')
+        # A search per image is bounded by SauceNao's daily quota, so their answers are kept for the whole run
+        self.searches = SingleFlight('search', keep=True)
+        self.placed = {}
+
+        # Hashing runs in a process pool on this thread, every later stage has its own workers.
+        # Placement is planned by one worker and carried out by the file operation pool
+        self.file_operations = FileOperations(self.file_workers, self.dry_run)
+        self.file_stage = Stage('File operations', self.place_file)
+        self.search_stage = Stage('Reverse search', self.search_file, self.search_workers)
+        self.phash_stage = Stage('Perceptual hash', self.fingerprint_file, self.phash_workers)
+        self.lookup_stage = Stage('Danbooru lookup', self.lookup_batch, self.lookup_workers)
+
+        self.hasher = Hasher(self.hash_workers, self.hash_cache)
+        watcher = None
+        if self.watching:
+            # Started before the first scan, so nothing arriving during it is missed
+            watcher = Watcher(self.base_directories, self.depth, {'.images'}, self.output_folders,
+                              self.settle, self.poll_interval)
+
+        reporters = []
+        if self.quiet:
+            set_quiet(True)
+            reporters.append(metrics.Progress(metrics.shared()).start())
+        if self.metrics_path:
+            reporters.append(metrics.Exporter(metrics.shared(), self.metrics_path, self.metrics_interval).start())
+
+        with Pipeline(self.lookup_stage, self.phash_stage, self.search_stage, self.file_stage):
+            if not self.draining:
+                for batch in self.batches(self.hash_stage(self.scan_files())):
+                    self.lookup_stage.put(batch)
+            self.search_queued()
+            if watcher is not None:
+                self.watch(watcher)
+        self.file_operations.close()
+        self.hasher.close()
+        self.booru.close()
+        for reporter in reporters:
+            reporter.close()
+
+        print(f'{MAJOR_PROMPT}Found {self.found} images.')
+        if self.skipped:
+            print(f'{ERROR_PROMPT}Skipped {self.skipped} images previously marked as unknown.')
+        shared = metrics.shared().total('coalesced_total')
+        if shared:
+            print(f'{MAJOR_PROMPT}Identical images saved {shared:.0f} lookups and searches, and '
+                  f'{metrics.shared().total("bytes_saved_total") / 1024 ** 2:.1f} MiB of uploads and copies.')
+        waiting = self.search_queue.count(self.base_directories) if self.do_reverse_image else 0
+        if waiting:
+            print(f'{MAJOR_PROMPT}{waiting} images wait for a reverse search, {self.quota.available()} SauceNao '
+                  f'searches are left until the quota frees up in {self.quota.reset_in() / 3600:.1f}h. '
+                  f'--drain-searches searches them as it does.')
+
+        self.checkpoint.complete()
+        if self.thumbnail_pool is not None:
+            self.thumbnail_pool.shutdown()
+        self.unknown.close()
+        self.booru_cache.flush()
+        self.database.commit()
+        print(f'{MAJOR_PROMPT}All Operations finished\n')
+
+    def batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def lookup_batch(self, batch: list) -> None:
+        # Catches unknown files that were renamed or copied since they were marked
+        known = [(file_, md5) for file_, md5 in batch if not self.unknown.has_md5(md5)]
+        if len(known) != len(batch):
+            log(f'{ERROR_PROMPT}Skipped {len(batch) - len(known)} images previously marked as unknown by their hash.')
+            metrics.count('images_total', len(batch) - len(known), result='skipped')
+            for file_, md5 in batch:
+                if self.unknown.has_md5(md5):
+                    self.finished(file_)
+        batch = known
+        if not batch:
+            return
+
+        files = {}
+        for file_, md5 in batch:
+            files.setdefault(md5, []).append(file_)
+
+        # Hashes another batch already looks up are waited for rather than asked again
+        claims = {md5: self.lookups.claim(md5) for md5 in files}
+        asking = [md5 for md5, (_, leader) in claims.items() if leader]
+        settled = set()
+
+        def settle(md5: str, post) -> None:
+            # Found posts are passed on at once, not held back until every booru answered for the whole batch
+            settled.add(md5)
+            self.lookups.settle(md5, claims[md5][0], post)
+            self.looked_up(files[md5], md5, post)
+
+        try:
+            posts, unanswered = self.booru.get_from_md5_many(asking, settle)
+        except Exception as e:
+            for md5 in asking:
+                if md5 not in settled:
+                    self.lookups.fail(md5, claims[md5][0], e)
+            raise
+        for md5 in asking:
+            if md5 in unanswered:
+                self.lookups.fail(md5, claims[md5][0], ConnectionError('no booru could be asked'))
+                self.not_looked_up(files[md5])
+            elif md5 not in settled:
+                settle(md5, None)
+        log(f'{MINOR_PROMPT}Searched Danbooru for {len(asking)} hashes, {len(posts)} found.')
+
+        for md5, (future, leader) in claims.items():
+            if not leader:
+                try:
+                    post = future.result()
+                except Exception as e:
+                    log(f'{ERROR_PROMPT}Looking up {md5} failed: {e}', important=True)
+                    self.not_looked_up(files[md5])
+                    continue
+                self.looked_up(files[md5], md5, post)
+
+    def not_looked_up(self, files: list) -> None:
+        # Not a miss: left unfinished rather than marked unknown or searched, so the next run looks them up again
+        for file_ in files:
+            log(f'{ERROR_PROMPT}No booru could be asked about {file_}, it is looked up again next run.')
+        metrics.count('images_total', len(files), result='deferred')
 
-        skipped = 0
+    def looked_up(self, files: list, md5: str, post: dict) -> None:
         for file_ in files:
-            filename = file_[::-1].split('.', 1)[1][::-1]
-            filename_long = file_
-            file_ = os.path.join(self.base_directory, file_)
+            if post:
+                log(f'{MAJOR_PROMPT}{file_} {NORMAL}found on Danbooru by {md5} {OKAY}{NORMAL}')
+            if self.near_duplicates is not None:
+                self.phash_stage.put((file_, md5, post))
+            else:
+                self.identified(file_, md5, post)
+
+    def identified(self, file_: str, md5: str, post: dict) -> None:
+        if post or not self.do_reverse_image:
+            self.file_stage.put((file_, md5, post))
+        elif self.dry_run:
+            # Searching would publish the image and spend SauceNao's quota, a preview only says it would search
+            log(f'{ACTION_PROMPT}[Dry run] reverse search {file_}')
+            metrics.count('images_total', result='deferred')
+            self.finished(file_)
+        else:
+            # Searched best first once the scan is done, as far as the quota goes, and kept for later runs until then
+            self.search_queue.add(file_, md5, self.root_for(file_))
+            metrics.count('searches_queued_total')
+            self.finished(file_)
+
+    def search_queued(self) -> None:
+        """
+        Reverse search queued images best first, as many as SauceNao's quota allows.
+        When draining, wait for the quota to free up again until no image is left.
+        """
+        if not self.do_reverse_image or self.dry_run:
+            return
+        # Images still being looked up may have to be queued too
+        self.lookup_stage.join()
+        self.phash_stage.join()
+
+        while True:
+            # Images deferred by an earlier pass may fit the quota by now, nothing is being searched between passes
+            self.search_queue.release()
+            while self.queue_searches():
+                self.search_stage.join()
 
-            if file_ in self.unknown:
-                skipped += 1
+            waiting = self.search_queue.count(self.base_directories)
+            # Images left while searches are, were held back by something other than the quota
+            if not self.draining or not waiting or self.quota.available():
+                return
+
+            # Nothing else is written for hours
+            self.database.commit()
+            wait = self.quota.reset_in()
+            print(f'{MAJOR_PROMPT}SauceNao quota used up with {waiting} images left, waiting {wait / 3600:.1f}h for it '
+                  f'to free up. Press Ctrl+C to stop.')
+            try:
+                time.sleep(wait + 1)
+            except KeyboardInterrupt:
+                return
+
+    def queue_searches(self) -> int:
+        """
+        Hand the best queued images to the search stage, as many as there are searches left.
+        Returns the number of images taken from the queue.
+        """
+        # The queue holds absolute paths, the rest of the run uses them as the scan found them
+        roots = {os.path.abspath(i): i for i in self.base_directories}
+        queued = self.search_queue.take(self.quota.available(), list(roots))
+        for path, md5, root in queued:
+            if not os.path.isfile(path):
+                # Moved or deleted since it was queued
+                self.search_queue.remove(path)
                 continue
-            print()
-            if skipped:
-                print(f'{ERROR_PROMPT}Skipped {skipped} images previously marked as unknown.')
-                skipped = 0
+            path = os.path.join(roots[root], os.path.relpath(path, root))
+            self.checkpoint.add(self.root_for(path))
+            self.search_stage.put((path, md5))
+        return len(queued)
 
-            print(f'{MAJOR_PROMPT}Operating on {file_}')
+    def fingerprint_file(self, item: tuple) -> None:
+        """
+        Remember the perceptual hash of identified files, and try to identify the rest as near-duplicates of them
+        before resorting to a reverse image search.
+        """
+        file_, md5, post = item
+        try:
+            hsh = imaging.dhash(file_)
+        except (OSError, ValueError):
+            # Not an image Pillow can read, nothing to compare
+            self.identified(file_, md5, post)
+            return
 
-            md5 = self.get_md5(file_, str(filename))
+        if post:
+            self.near_duplicates.add(md5, hsh, post)
+        else:
+            post = self.near_duplicates.get(hsh)
+            if post:
+                log(f'{MAJOR_PROMPT}{file_} {NORMAL}found as a near-duplicate of a known image {OKAY}{NORMAL}')
+        self.identified(file_, md5, post)
 
-            print(f'{MINOR_PROMPT}Searching Danbooru for {md5}..{NORMAL}', end=' ', flush=True)
-            danbooru_result = Booru().get_from_md5(md5)
+    def search_file(self, item: tuple) -> None:
+        file_, md5 = item
+        future, leader = self.searches.claim(md5)
+        if not leader:
+            # An identical image is searched already, this one is placed by its answer
+            future.add_done_callback(lambda done: self.searched(file_, md5, done))
+            return
 
-            if self.do_reverse_image and not danbooru_result:
-                print(NOT_FOUND)
+        try:
+            post = self.reverse_search(file_, md5)
+        except RateLimitExceeded as e:
+            self.searches.fail(md5, future, e)
+            self.defer(file_, e)
+            return
+        except Exception as e:
+            self.searches.fail(md5, future, e)
+            raise
+        self.searches.settle(md5, future, post)
+        self.search_queue.remove(file_)
+        self.file_stage.put((file_, md5, post))
 
-                # Upload image to chosen host
-                print(f'{MINOR_PROMPT}Uploading to {self.image_host.NAME} for reverse image search..{NORMAL}',
-                      end=' ', flush=True)
-                url = self.image_host.upload(file_)
-                if not url:
-                    print('[Failed]')
-                    self.mark_unknown(file_)
-                    print(ERROR_PROMPT + 'File could not be identified.')
-                    continue
-                else:
-                    print('')
+    def searched(self, file_: str, md5: str, future: concurrent.futures.Future) -> None:
+        try:
+            post = future.result()
+        except RateLimitExceeded as e:
+            self.defer(file_, e)
+            return
+        except Exception as e:
+            log(f'{ERROR_PROMPT}Searching an image identical to {file_} failed: {e}', important=True)
+            return
 
-                # Reverse image search
-                print(f'{MINOR_PROMPT}Searching SauceNao with {url}..{NORMAL}', end=' ', flush=True)
-                response = self.sauce_nao.request(url)
-                results = response.results
+        log(f'{MAJOR_PROMPT}{file_} {NORMAL}shared the search of an identical image '
+            f'{OKAY if post else NOT_FOUND}{NORMAL}')
+        if self.image_host is not None and not self.direct_search:
+            try:
+                metrics.count('bytes_saved_total', os.path.getsize(file_), kind='upload')
+            except OSError:
+                pass
+        self.search_queue.remove(file_)
+        self.file_stage.put((file_, md5, post))
 
-                # Remove all low similarity results
-                for header, data in results:
-                    if float(header['similarity']) < 90.0:
-                        results.remove((header, data))
+    def defer(self, file_: str, error: Exception) -> None:
+        # Left in the queue rather than marked unknown, so it is searched once the limit allows
+        log(f'{ERROR_PROMPT}{error}. {file_} stays queued for now.')
+        metrics.count('images_total', result='deferred')
+        self.finished(file_)
 
-                # Get danbooru id, if any high similarity result has one, then get danbooru post from it
-                if any('danbooru_id' in x for _, x in results):
-                    print(OKAY)
-                    danbooru_id = [i['danbooru_id'] for _, i in results if 'danbooru_id' in i][0]
+    def reverse_search(self, file_: str, md5: str) -> Post:
+        """
+        Returns the post found for file_, None if there is none.
+        """
+        # Taken from the quota first, so nothing is uploaded for a search that can't be made
+        self.sauce_nao.reserve()
+        try:
+            response, url = self.search_image(file_)
+        except RateLimitExceeded:
+            # SauceNao gave back what it didn't count against the day already
+            raise
+        except Exception:
+            self.sauce_nao.refund()
+            raise
+        if response is None:
+            self.sauce_nao.refund()
+            return None
 
-                    danbooru_result = Booru().get_from_id(danbooru_id)
-                else:
-                    print(NOT_FOUND)
-            elif danbooru_result:
-                print(OKAY)
-                danbooru_result = danbooru_result[0]
-            else:
-                print(NOT_FOUND)
+        # Tags straight from the results where they have them, a Danbooru lookup by id otherwise
+        post = self.resolver.resolve(response, md5)
+        if post:
+            log(f'{MAJOR_PROMPT}{file_} {NORMAL}found on SauceNao with {url} {OKAY}{NORMAL}')
+            # Remembered by content, so a later run doesn't spend another search on the same image
+            self.booru_cache.put('md5:' + md5, post)
+            if self.near_duplicates is not None:
+                try:
+                    self.near_duplicates.add(md5, imaging.dhash(file_), post)
+                except (OSError, ValueError):
+                    pass
+        else:
+            log(f'{MAJOR_PROMPT}{file_} {NORMAL}searched on SauceNao with {url} {NOT_FOUND}{NORMAL}')
+        return post
 
-            if danbooru_result:
-                b_image = BImage(danbooru_result)
+    def search_image(self, file_: str) -> tuple:
+        """
+        Returns SauceNao's answer for file_ and what was searched, (None, None) if no search could be made.
+        """
+        response = self.search_thumbnail(file_) if self.direct_search else None
+        if response is not None:
+            return response, 'a thumbnail'
+        if self.image_host is None:
+            return None, None
 
-                if (b_image.char_count >= 1 and self.sort_by != self.SERIES) or \
-                        (b_image.copy_right_count >= 1 and self.sort_by != self.CHARACTER):
-                    self.copy_move_file(file_, filename_long, b_image)
-                else:
-                    self.mark_unknown(file_)
-                    print(ERROR_PROMPT + 'File was identified but no relevant information was found.')
+        # Upload image to chosen host
+        url = self.image_host.upload(file_)
+        if not url:
+            log(f'{MINOR_PROMPT}Uploading {file_} to {self.image_host.NAME} failed.')
+            return None, None
+
+        # Reverse image search
+        return self.sauce_nao.request(url), url
+
+    def search_thumbnail(self, file_: str):
+        """
+        Reverse search a small thumbnail posted straight to SauceNao. Returns None if no thumbnail could be made.
+        """
+        try:
+            data = self.thumbnail_pool.submit(imaging.thumbnail, file_).result()
+        except (OSError, ValueError):
+            log(f'{MINOR_PROMPT}Could not make a thumbnail of {file_}.')
+            return None
+
+        return self.sauce_nao.request_file(data)
+
+    def place_file(self, item: tuple) -> None:
+        file_, md5, danbooru_result = item
+        filename_long = os.path.basename(file_)
+
+        if danbooru_result:
+            b_image = BImage(danbooru_result)
+
+            if self.relevant(b_image):
+                self.copy_move_file(file_, filename_long, b_image, md5, danbooru_result)
+                metrics.count('images_total', result='placed')
+                return
             else:
-                self.mark_unknown(file_)
-                print(ERROR_PROMPT + 'File could not be identified.')
+                # Kept in the manifest, so a re-sort under other settings can still place it
+                if not self.dry_run:
+                    self.manifest.put(self.root_for(file_), filename_long, md5, danbooru_result, file_, [], file_)
+                self.mark_unknown(file_, md5)
+                log(f'{ERROR_PROMPT}{file_} was identified but no relevant information was found.')
+                metrics.count('images_total', result='unknown')
+        elif self.offline:
+            # Not in the cache, leave it to be looked up by the next online run
+            log(f'{ERROR_PROMPT}{file_} is not in the Danbooru cache.')
+            metrics.count('images_total', result='deferred')
+        else:
+            self.mark_unknown(file_, md5)
+            log(f'{ERROR_PROMPT}{file_} could not be identified.')
+            metrics.count('images_total', result='unknown')
+        self.finished(file_)
 
-        if skipped:
-            print(f'{ERROR_PROMPT}Skipped {skipped} images previously marked as unknown.')
-        print(f'{MAJOR_PROMPT}All Operations finished\n')
+    def relevant(self, b_image: BImage) -> bool:
+        return (b_image.char_count >= 1 and self.sort_by != self.SERIES) or \
+               (b_image.copy_right_count >= 1 and self.sort_by != self.CHARACTER)
 
-    def mark_unknown(self, path: str) -> None:
-        self.unknown.append(path)
-        with open('unknown.txt', 'w') as file_:
-            file_.write('\n'.join(self.unknown))
+    def finished(self, file_: str) -> None:
+        self.checkpoint.finish(self.root_for(file_))
+
+    def mark_unknown(self, path: str, md5: str = None) -> None:
+        if not self.dry_run:
+            self.unknown.add(path, md5)
 
     @staticmethod
     def ask(prompt, options=None, preamble=None):
@@ -189,25 +660,52 @@ class Program:
             return {i[0].upper(): i for i in options}.get((value or ' ')[0].upper())
         return value
 
+    @staticmethod
+    def expand_directories(patterns: list) -> list:
+        directories = []
+        for pattern in patterns:
+            # The shell leaves quoted or unmatched globs alone
+            for directory in sorted(glob.glob(pattern)) or [pattern]:
+                directory = os.path.normpath(directory)
+                if directory not in directories:
+                    directories.append(directory)
+        return directories
+
+    def root_for(self, file_: str) -> str:
+        """
+        The directory given on the command line that file_ was found in.
+        """
+        return max((i for i in self.base_directories if file_.startswith(i.rstrip(os.sep) + os.sep)),
+                   key=len, default=self.base_directories[0])
+
     def get_settings(self) -> bool:
-        if self.base_directory is None:
+        if self.base_directories is None:
             directory = self.ask('Enter image directory:')
 
-            self.base_directory = directory or os.getcwd()
-            if not os.path.exists(directory):
+            self.base_directories = [os.path.normpath(directory or os.getcwd())]
+        for directory in self.base_directories:
+            if not os.path.isdir(directory):
                 print(f'{ERROR_PROMPT}{directory} is not a valid directory.')
                 return False
-        print(f'{BOLD}Directory "{self.base_directory}" selected.\n')
+        if len(self.base_directories) == 1:
+            print(f'{BOLD}Directory "{self.base_directories[0]}" selected.\n')
+        else:
+            print(f'{BOLD}{len(self.base_directories)} directories selected.\n')
 
         if self.sort_by is None:
             self.sort_by = self.ask('Sort by', [self.SERIES, self.CHARACTER, self.BOTH])
             if self.sort_by is None:
                 return False
         if self.file_operation is None:
-            self.file_operation = self.ask('File processing manner:', [self.MOVE, self.COPY])
+            self.file_operation = self.ask('File processing manner:', [self.MOVE, self.COPY, self.HARDLINK, self.REFLINK],
+                                           'Hardlink and Reflink place the file without copying its bytes.\n'
+                                           ' Hardlinks need the same filesystem, reflinks one like btrfs or XFS.')
             if self.file_operation is None:
                 return False
-        if self.md5_option is None:
+        if self.resorting:
+            # Hashing and reverse searching don't apply, everything comes from the manifest
+            return True
+        if self.md5_option is None and not self.draining:
             self.md5_option = self.ask('Hash calculation:', [self.HARD, self.SOFT],
                                        'Hard always uses file-hashes.\n'
                                        ' Lower success rate and speed but no false positives.\n'
@@ -226,26 +724,182 @@ class Program:
                 return False
             self.do_reverse_image = self.do_reverse_image == 'Yes'
         if self.do_reverse_image and self.image_host is None:
-            self.image_host = self.ask('Image host:', [self.IMGUR, self.NOLIFE])
+            self.image_host = self.ask('Image host:', [self.DIRECT, self.IMGUR, self.NOLIFE],
+                                       'Direct posts a small thumbnail straight to SauceNao.\n'
+                                       'Imgur and NoLife upload the full image and pass its url on.')
             if self.image_host is None:
                 return False
 
         return True
 
-    def get_md5(self, file_: str, filename: str) -> str:
+    def scan_files(self):
+        """
+        Yield image files as the directory walk finds them, leaving out the ones previously marked as unknown and
+        the folders sorting created.
+        """
+        for root in self.base_directories:
+            if root in self.checkpoint.done:
+                continue
+
+            for entry in scan(root, self.depth, exclude_names={'.images'}, exclude_paths=self.output_folders):
+                self.found += 1
+                metrics.count('files_scanned_total')
+                if entry.path in self.unknown:
+                    self.skipped += 1
+                    metrics.count('images_total', result='skipped')
+                else:
+                    self.checkpoint.add(root)
+                    yield entry
+            self.checkpoint.scan_finished(root)
+
+    def hash_stage(self, files):
+        """
+        Yield (path, md5) for every file. Soft hashes are taken straight from the filename,
+        everything else is streamed through a process pool and yielded as digests finish.
+        """
+        for path, md5 in self.hasher.hash_files(files, known=self.get_soft_md5):
+            if md5 is None:
+                # Gone or unreadable, but its root still waits for it before it counts as done
+                self.finished(path)
+                continue
+            yield path, md5
+
+    def watch(self, watcher: Watcher) -> None:
+        """
+        Feed new files into the running pipeline as they arrive, until interrupted.
+        """
+        print(f'{MAJOR_PROMPT}Watching for new images{" by polling" if watcher.polling else ""}, '
+              f'press Ctrl+C to stop.')
+        try:
+            for paths in watcher:
+                files = []
+                for path in paths:
+                    # Sorting may already have moved it, if it arrived while the first scan ran
+                    if path in self.unknown or not os.path.isfile(path):
+                        continue
+                    self.found += 1
+                    metrics.count('files_scanned_total')
+                    self.checkpoint.add(self.root_for(path))
+                    files.append(path)
+
+                for batch in self.batches(self.hash_stage(files)):
+                    self.lookup_stage.put(batch)
+                self.search_queued()
+                # Otherwise a quiet stretch could leave the last answers uncommitted for a long time
+                self.database.commit()
+        except KeyboardInterrupt:
+            print(f'\n{MAJOR_PROMPT}Stopped watching, finishing queued images.')
+        finally:
+            watcher.close()
+
+    def get_soft_md5(self, file_: str) -> str:
         # improves speed, may reduce accuracy, when a file has a name that could be its MD5 hash, but isn't
+        filename = os.path.basename(file_).rsplit('.', 1)[0]
         if self.md5_option == self.SOFT and self.md5_regex.match(filename):
             return filename
-        else:
-            return self.calculate_md5(file_)
+        return None
 
-    @staticmethod
-    def calculate_md5(filename: str) -> str:
-        with open(filename, 'rb') as file_:
-            hsh = hashlib.md5(file_.read())
-        return hsh.hexdigest().lower()
+    def register_output(self, folder: str) -> None:
+        # Tags can contain slashes, so the folder directly under the base directory is the one to remember
+        root = self.root_for(folder)
+        top = os.path.relpath(folder, root).split(os.sep)[0]
+        self.output_folders.add(os.path.join(root, top))
+
+    def copy_move_file(self, file_: str, filename: str, b_image: BImage, md5: str, post: dict) -> None:
+        filename, ops = self.free_name(file_, filename, md5, b_image)
+        if filename is None:
+            log(f'{ERROR_PROMPT}Other images already hold every name for {file_}, it stays where it is.',
+                important=True)
+            self.finished(file_)
+            return
+        ops = self.not_in_place(ops)
+
+        # Identical images placed earlier in the run are linked to instead of copied again
+        first, after = self.placed.get(md5, (None, None))
+        if first is not None:
+            copies = sum(op.kind == file_ops.COPY for op in ops)
+            if not copies:
+                after = None
+            else:
+                ops = [Op(file_ops.SHARE, first, op.dst) if op.kind == file_ops.COPY else op for op in ops]
+                try:
+                    metrics.count('bytes_saved_total', copies * os.path.getsize(file_), kind='copy')
+                except OSError:
+                    pass
+
+        if not self.dry_run:
+            moved = any(op.kind == file_ops.RENAME and op.src == file_ for op in ops)
+            self.manifest.put(self.root_for(file_), filename, md5, post, None if moved else file_,
+                              [op.dst for op in ops if op.kind != file_ops.MKDIR], file_)
+        claimed = self.claim(ops, md5)
+        future = self.file_operations.submit(ops, lambda: self.placed_file(file_, claimed), after=after)
+        if first is None:
+            # Symlinks only point at the file, anything else holds its bytes
+            first = next((op.dst for op in ops if op.kind not in (file_ops.MKDIR, file_ops.SYMLINK)), None)
+            if first is not None:
+                self.placed[md5] = first, future
+                if future is not None:
+                    # Once the file is there only its path is needed, not the future and its callbacks
+                    future.add_done_callback(lambda done: self.placed.update({md5: (first, None)}))
+
+    def free_name(self, file_: str, filename: str, md5: str, b_image: BImage, own: list = ()) -> tuple:
+        """
+        Returns (filename, ops) placing file_ without replacing another image. When an image of another folder
+        already holds the name, this one gets its md5 added to it, so it ends up with the same name on every run.
+        own are paths already holding this image. (None, []) when every name is taken.
+        """
+        stem, extension = os.path.splitext(filename)
+        for name in (filename, f'{stem}_{md5[:8]}{extension}', f'{stem}_{md5}{extension}'):
+            ops = self.plan_file(file_, name, b_image)
+            if all(op.dst in own or self.holds(op.dst, file_, md5) for op in ops if op.kind != file_ops.MKDIR):
+                return name, ops
+        return None, []
+
+    def holds(self, path: str, file_: str, md5: str) -> bool:
+        """
+        Whether path can take file_: nothing is there, or nothing but the same image is, now or once the
+        operations still running are done.
+        """
+        with self.claims_lock:
+            claimed = self.claims.get(path)
+        if claimed is not None:
+            return claimed == md5
+        if not os.path.lexists(path):
+            return True
+
+        try:
+            if os.path.samefile(path, file_):
+                return True
+            stat = os.stat(path)
+            held = self.hash_cache.get(path, stat)
+            if held is None:
+                held = md5_file(path)
+                self.hash_cache.put(path, stat, held)
+        except OSError:
+            return False
+        return held == md5
+
+    def claim(self, ops: list, md5: str) -> list:
+        paths = [op.dst for op in ops if op.kind not in (file_ops.MKDIR, file_ops.REMOVE)]
+        with self.claims_lock:
+            self.claims.update(dict.fromkeys(paths, md5))
+        return paths
+
+    def unclaim(self, paths: list) -> None:
+        # Dry runs create nothing, so later images still have to see the paths as taken
+        if not self.dry_run:
+            with self.claims_lock:
+                for path in paths:
+                    self.claims.pop(path, None)
 
-    def copy_move_file(self, file_: str, filename: str, b_image: BImage) -> None:
+    def placed_file(self, file_: str, claimed: list) -> None:
+        self.unclaim(claimed)
+        self.finished(file_)
+
+    def plan_file(self, file_: str, filename: str, b_image: BImage) -> list:
+        """
+        Work out the folders and file operations that place file_, without touching the disk.
+        """
         sort_by = self.sort_by
         if sort_by == self.BOTH:
             sort_by = self.CHARACTER
@@ -256,56 +910,181 @@ class Program:
         else:
             tds = ['']
 
-        if self.multiple_operation == self.COPIES and self.file_operation == self.COPY:
-            store_dir = os.path.join(self.base_directory, '.images')
-            print(ACTION_PROMPT + f'Moving to {store_dir}')
-            if not os.path.exists(store_dir):
-                os.makedirs(store_dir)
-            os.rename(file_, os.path.join(store_dir, filename))
+        if sort_by == self.CHARACTER:
+            target_folders = b_image.characters if self.multiple_operation == self.COPIES else \
+                             [b_image.characters_string] if self.multiple_operation == self.MIXED else \
+                             [b_image.characters[0]] if self.multiple_operation == self.FIRST else []
+        else:
+            target_folders = b_image.copy_rights if self.multiple_operation == self.COPIES else \
+                             [b_image.copy_rights_string] if self.multiple_operation == self.MIXED else \
+                             [b_image.copy_rights[0]] if self.multiple_operation == self.FIRST else []
+
+        root = self.root_for(file_)
+        targets = [os.path.join(root, base_directory, target_folder, filename)
+                   for base_directory in tds for target_folder in target_folders]
+        ops = []
+        last = len(targets) - 1
+        if self.file_operation == self.MOVE:
+            # Already at one of its targets, the file stays there and the others get copies
+            last = next((n for n, i in enumerate(targets) if file_ops.same_file(file_, i)), last)
+
+        if targets and self.multiple_operation == self.COPIES and self.file_operation == self.COPY:
+            store_dir = os.path.join(root, '.images')
+            ops.append(Op(file_ops.MKDIR, None, store_dir))
+            ops.append(Op(file_ops.RENAME, file_, os.path.join(store_dir, filename)))
             file_ = os.path.join(store_dir, filename)
 
-        for base_directory in tds:
-            base_directory = os.path.join(self.base_directory, base_directory)
-            if not os.path.exists(base_directory):
-                os.makedirs(base_directory)
+        # Copy/move file in target folder(s)
+        for n, target_file in enumerate(targets):
+            target_folder = os.path.dirname(target_file)
+            ops.append(Op(file_ops.MKDIR, None, target_folder))
+            if not self.dry_run:
+                self.register_output(target_folder)
 
-            if sort_by == self.CHARACTER:
-                target_folders = b_image.characters if self.multiple_operation == self.COPIES else \
-                                 [b_image.characters_string] if self.multiple_operation == self.MIXED else \
-                                 [b_image.characters[0]] if self.multiple_operation == self.FIRST else []
-            else:
-                target_folders = b_image.copy_rights if self.multiple_operation == self.COPIES else \
-                                 [b_image.copy_rights_string] if self.multiple_operation == self.MIXED else \
-                                 [b_image.copy_rights[0]] if self.multiple_operation == self.FIRST else []
-
-            # Copy/move file in target folder(s)
-            for n, src_target_folder in enumerate(target_folders):
-                target_file = os.path.join(base_directory, src_target_folder, filename)
-                target_folder = os.path.dirname(target_file)
-
-                if not os.path.exists(target_folder):
-                    os.makedirs(target_folder)
-
-                if self.file_operation == self.COPY:
-                    if self.multiple_operation == self.COPIES:
-                        print(ACTION_PROMPT + f'Linking to {target_folder}')
-                        cwd = os.getcwd()
-                        os.chdir(target_folder)
-                        f = os.path.join('..', '..' if self.sort_by == self.BOTH else '', '.images', filename)
-                        os.symlink(f, filename)
-                        os.chdir(cwd)
-                    else:
-                        print(ACTION_PROMPT + f'Copying to {target_folder}')
-                        copyfile(file_, target_file)
-                elif self.file_operation == self.MOVE:
-                    print(ACTION_PROMPT + f'Moving to {target_folder}')
-                    if n == len(target_folders) - 1:
-                        if os.path.exists(target_file):
-                            os.remove(target_file)
-                        os.rename(file_, target_file)
-                    else:
-                        copyfile(file_, target_file)
+            if self.file_operation == self.COPY:
+                if self.multiple_operation == self.COPIES:
+                    ops.append(Op(file_ops.SYMLINK, os.path.relpath(file_, target_folder), target_file))
+                else:
+                    ops.append(Op(file_ops.COPY, file_, target_file))
+            elif self.file_operation == self.HARDLINK:
+                ops.append(Op(file_ops.HARDLINK, file_, target_file))
+            elif self.file_operation == self.REFLINK:
+                ops.append(Op(file_ops.REFLINK, file_, target_file))
+            elif self.file_operation == self.MOVE:
+                if n == last:
+                    ops.append(Op(file_ops.RENAME, file_, target_file))
+                else:
+                    ops.append(Op(file_ops.COPY, file_, target_file))
+
+        return ops
+
+    @staticmethod
+    def not_in_place(ops: list) -> list:
+        # Placing a file onto itself, as when re-sorting an already sorted folder, would at best do nothing
+        return [op for op in ops if op.kind in (file_ops.MKDIR, file_ops.SYMLINK, file_ops.REMOVE) or
+                not file_ops.same_file(op.src, op.dst)]
+
+    def resort(self) -> None:
+        """
+        Lay out every image in the manifest under the current settings, running only the operations that differ
+        from what is already on disk.
+        """
+        # Manifest paths are absolute, the roots have to be too for plan_file to find them
+        self.base_directories = [os.path.abspath(i) for i in self.base_directories]
+        self.file_operations = FileOperations(self.file_workers, self.dry_run)
+        changed = unchanged = missing = 0
+        folders = set()
+
+        for root in self.base_directories:
+            for entry in self.manifest.entries(root):
+                planned = self.plan_resort(entry)
+                if planned is None:
+                    log(f'{ERROR_PROMPT}{entry.filename} is no longer in {root}.')
+                    missing += 1
+                    continue
+
+                ops, filename, source, paths = planned
+                if not any(op.kind != file_ops.MKDIR for op in ops):
+                    unchanged += 1
+                    continue
+
+                changed += 1
+                folders.update(os.path.dirname(op.src if op.kind == file_ops.RENAME else op.dst) for op in ops
+                               if op.kind in (file_ops.REMOVE, file_ops.RENAME))
+                claimed = self.claim(ops, entry.md5)
+                self.file_operations.submit(ops, lambda claimed=claimed: self.unclaim(claimed))
+                if not self.dry_run:
+                    self.manifest.put(root, filename, entry.md5, entry.post, source, paths, entry.found)
+        self.file_operations.close()
+
+        if not self.dry_run:
+            self.remove_empty_folders(folders)
+        print(f'{MAJOR_PROMPT}Re-sorted {changed} images, {unchanged} were already in place.')
+        if missing:
+            print(f'{ERROR_PROMPT}{missing} images in the manifest could not be found.')
+        self.database.commit()
+
+    def plan_resort(self, entry) -> tuple:
+        """
+        Diff where entry should be against where it is. Returns (ops, filename, source, paths) to record once they
+        ran, or None if none of the image's files exist any more.
+        """
+        existing = [i for i in entry.paths if os.path.lexists(i)]
+        sources = [i for i in existing if not os.path.islink(i)]
+        if not sources and entry.source and os.path.isfile(entry.source):
+            sources = [entry.source]
+        if not sources:
+            return None
+        source = sources[0]
+
+        b_image = BImage(entry.post)
+        filename, planned = entry.filename, []
+        if self.relevant(b_image):
+            filename, planned = self.free_name(source, entry.filename, entry.md5, b_image, existing)
+            if filename is None:
+                log(f'{ERROR_PROMPT}Other images already hold every name for {source}, it stays where it is.')
+                return [], entry.filename, entry.source, entry.paths
+        wanted = {op.dst: op.kind for op in planned if op.kind != file_ops.MKDIR}
+
+        if not wanted and source != entry.source:
+            # Nothing to sort it into, so it goes back to where it was found, like an image that was never sorted
+            original = entry.found
+            if os.path.lexists(original):
+                # Taken by another file, leave this one where it is
+                return [], filename, entry.source, entry.paths
+            planned = [Op(file_ops.MKDIR, None, os.path.dirname(original)), Op(file_ops.RENAME, source, original)]
+            entry = entry._replace(source=original)
+
+        ops = []
+        consumed = False
+        for op in planned:
+            if op.kind == file_ops.MKDIR:
+                ops.append(op)
+                continue
+            if op.dst in existing and not (op.dst == source and consumed) and self.in_place(op.dst, op.kind):
+                continue
+
+            if op.kind == file_ops.RENAME and op.src == source:
+                if source in wanted and self.in_place(source, wanted[source]):
+                    # The source stays where it is as one of the wanted files
+                    op = op._replace(kind=file_ops.COPY)
+                else:
+                    consumed = True
+            if op.dst in existing and op.dst != source:
+                # There, but the wrong kind of file, like a copy where a symlink belongs
+                ops.append(Op(file_ops.REMOVE, None, op.dst))
+            ops.append(op)
+
+        removed = [i for i in existing if i not in wanted and i != entry.source and not (i == source and consumed)]
+        if source in removed:
+            # Moving the source to its last use is cheaper than copying it and removing it afterwards
+            for n in range(len(ops) - 1, -1, -1):
+                if ops[n].src == source and ops[n].kind in (file_ops.COPY, file_ops.HARDLINK, file_ops.REFLINK):
+                    ops[n] = ops[n]._replace(kind=file_ops.RENAME)
+                    removed.remove(source)
+                    consumed = True
+                    break
+        ops.extend(Op(file_ops.REMOVE, None, i) for i in removed)
+
+        source = None if entry.source and consumed and source == entry.source else entry.source
+        return self.not_in_place(ops), filename, source, list(wanted)
+
+    @staticmethod
+    def in_place(path: str, kind: str) -> bool:
+        if kind == file_ops.SYMLINK:
+            return os.path.islink(path)
+        return os.path.lexists(path) and not os.path.islink(path)
 
+    def remove_empty_folders(self, folders: set) -> None:
+        # Deepest first, so a folder emptied by removing its sub-folders goes too
+        for folder in sorted(folders, key=len, reverse=True):
+            root = self.root_for(folder)
+            while folder != root and folder.startswith(root + os.sep):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
 
 if __name__ == '__main__':
     Program()
@@ -1,57 +1,463 @@
-﻿import requests
+﻿import collections
+import concurrent.futures
+import functools
+import os
+import threading
 import time
+import urllib.parse
+
+import requests
+
+from typing import Callable, Iterable
+
+from . import metrics
+from . import session as http
+from .post import Post
+
+
+@functools.lru_cache(maxsize=65536)
+def split_tags(tags: str) -> tuple:
+    # Posts with the same tag string share one split
+    return tuple(tags.split(' '))
 
 
 class BImage:
-    SFW = False
+    __slots__ = ('char_count', 'characters_string', 'characters', 'copy_right_count', 'copy_rights_string',
+                 'copy_rights', 'SFW')
 
-    def __init__(self, j_token):
-        self.char_count = int(j_token['tag_count_character'])
-        self.characters_string = str(j_token['tag_string_character'])
-        self.characters = self.characters_string.split(' ')
+    def __init__(self, post: Post):
+        if not isinstance(post, Post):
+            post = Post.from_dict(post)
 
-        self.copy_right_count = int(j_token['tag_count_copyright'])
-        self.copy_rights_string = str(j_token['tag_string_copyright'])
-        self.copy_rights = self.copy_rights_string.split(' ')
+        self.char_count = post.tag_count_character
+        self.characters_string = post.tag_string_character
+        self.characters = split_tags(self.characters_string)
 
-        rating = str(j_token['rating'])
+        self.copy_right_count = post.tag_count_copyright
+        self.copy_rights_string = post.tag_string_copyright
+        self.copy_rights = split_tags(self.copy_rights_string)
 
-        if rating == 's':
-            self.SFW = True
+        self.SFW = post.rating == 's'
 
 
-class Booru:
+class Provider:
+    """
+    One booru that posts can be looked up on by md5 or id, answering with Post records.
+    Lookups return None when the booru couldn't be asked, as opposed to an empty answer.
+    """
+    NAME = None
+    # Most hashes resolved per request, and requests made at the same time when a lookup needs several
+    BATCH_SIZE = 1
+    WORKERS = 4
+    # Name of a booru this one only holds a subset of, its misses are never worth asking here
+    MIRROR = None
+    HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) '
+                             'Chrome/41.0.2228.0 Safari/537.36Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 ('
+                             'KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36'}
+
+    def __init__(self, session: http.Session = None):
+        self.session = session or http.shared()
+
+    def get(self, url, params=None):
+        r = self.session.get(url, params=params, headers=self.HEADERS)
+        if r is None or r.status_code != 200:
+            return None
+        try:
+            return r.json()
+        except (ValueError, requests.exceptions.RequestException):
+            return None
+
+    def get_from_md5_many(self, md5s: list) -> dict:
+        """
+        Returns a dict of md5 -> Post for the hashes found, or None if the booru couldn't be reached.
+        """
+        batches = [md5s[i:i + self.BATCH_SIZE] for i in range(0, len(md5s), self.BATCH_SIZE)]
+        if len(batches) == 1:
+            return self.get_batch(batches[0])
+
+        found = {}
+        with concurrent.futures.ThreadPoolExecutor(self.WORKERS, thread_name_prefix=self.NAME) as pool:
+            for posts in pool.map(self.get_batch, batches):
+                if posts is None:
+                    return None
+                found.update(posts)
+        return found
+
+    def get_batch(self, md5s: list) -> dict:
+        raise NotImplementedError
+
+    def get_from_id(self, id_: int) -> Post:
+        raise NotImplementedError
+
+
+class Danbooru(Provider):
+    NAME = 'danbooru'
     ENDPOINT_MD5 = "https://danbooru.donmai.us/posts.json"
     ENDPOINT_ID = "https://danbooru.donmai.us/posts/"
+    # Most posts Danbooru returns for a single page, so the most hashes that can be resolved per request
+    BATCH_SIZE = 100
+    # Post fields BImage reads, Danbooru is asked for these only
+    FIELDS = Post._fields
 
-    @classmethod
-    def get(cls, url, params=None, headers=None, retry=2, tries=10):
-        r = requests.get(url, params=params, headers=headers)
+    def get_batch(self, md5s: list) -> dict:
+        params = {'limit': str(len(md5s)), 'tags': 'md5:' + ','.join(md5s), 'only': ','.join(self.FIELDS)}
+        posts = self.get(self.ENDPOINT_MD5, params=params)
+        if not isinstance(posts, list):
+            return None
 
-        if r.status_code != 200:
-            ra = int(r.headers.get('Retry-After', retry))
-            print(f'[ Sleeping for {ra}s ]', end=' ', flush=True)
+        # Posts hidden from anonymous users come back without their md5, they can't be matched
+        return {post['md5']: Post.from_dict(post) for post in posts if post.get('md5') in md5s}
 
-            if tries:
-                time.sleep(retry)
+    def get_from_id(self, id_: int) -> Post:
+        post = self.get(self.ENDPOINT_ID + str(id_) + '.json', params={'only': ','.join(self.FIELDS)})
+        return Post.from_dict(post) if isinstance(post, dict) and post.get('md5') else None
 
-                return cls.get(url, params=params, headers=headers, tries=tries-1)
-            return {}
 
-        return r.json()
+class Safebooru(Danbooru):
+    """
+    Danbooru's safe subset on its own hosts, only worth asking while Danbooru itself is slow.
+    """
+    NAME = 'safebooru'
+    ENDPOINT_MD5 = "https://safebooru.donmai.us/posts.json"
+    ENDPOINT_ID = "https://safebooru.donmai.us/posts/"
+    MIRROR = 'danbooru'
 
-    def get_from_md5(self, md5: str) -> dict:
-        params = {'limit': '1', 'tags': 'md5:' + md5}
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) '
-                                 'Chrome/41.0.2228.0 Safari/537.36Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 ('
-                                 'KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36'}
 
-        return self.get(self.ENDPOINT_MD5, params=params, headers=headers)
+class TaggedProvider(Provider):
+    """
+    A booru answering with one plain tag string, whose tag types have to be looked up separately.
+    Types are remembered, so each tag is only asked about once per run.
+    """
+    CHARACTER = 4
+    COPYRIGHT = 3
 
-    def get_from_id(self, id_: int) -> dict:
-        r = requests.get(self.ENDPOINT_ID + str(id_) + '.json')
-        try:
-            return r.json()
-        except requests.exceptions.RequestException:
-            print(r.text)
+    def __init__(self, session: http.Session = None):
+        super().__init__(session)
+        self.lock = threading.Lock()
+        # Held while asking, so lookups running side by side don't ask about the same new tags
+        self.asking = threading.Lock()
+        self.types = {}
+
+    def get_types(self, tags: list) -> dict:
+        """
+        Returns a dict of tag -> type for tags, unknown tags are left out.
+        """
+        raise NotImplementedError
+
+    def tag_types(self, tags: list) -> dict:
+        with self.lock:
+            missing = [i for i in tags if i not in self.types]
+        if missing:
+            with self.asking:
+                with self.lock:
+                    missing = [i for i in missing if i not in self.types]
+                types = self.get_types(missing) if missing else {}
+                with self.lock:
+                    for tag in missing:
+                        # Tags that couldn't be typed count as general ones
+                        self.types[tag] = types.get(tag, 0)
+        with self.lock:
+            return {i: self.types[i] for i in tags}
+
+    def from_tags(self, id_, md5: str, tags: str, rating: str) -> Post:
+        tags = tags.split()
+        types = self.tag_types(tags)
+        characters = [i for i in tags if types[i] == self.CHARACTER]
+        copyrights = [i for i in tags if types[i] == self.COPYRIGHT]
+        return Post.from_dict({
+            'id': id_,
+            'md5': md5,
+            'tag_string_character': ' '.join(characters),
+            'tag_count_character': len(characters),
+            'tag_string_copyright': ' '.join(copyrights),
+            'tag_count_copyright': len(copyrights),
+            # 'general' or 'g', 'safe' or 's', ...
+            'rating': (rating or '')[:1],
+        })
+
+
+class Gelbooru(TaggedProvider):
+    NAME = 'gelbooru'
+    ENDPOINT = 'https://gelbooru.com/index.php'
+    KEY_FILE = 'keys/gelbooruApiKey.txt'
+    # Most tags typed per request
+    TAG_BATCH = 100
+
+    def __init__(self, session: http.Session = None):
+        super().__init__(session)
+        # Optional, "api_key=...&user_id=..." as shown in the Gelbooru account settings
+        self.credentials = {}
+        if os.path.exists(self.KEY_FILE):
+            with open(self.KEY_FILE) as file_:
+                self.credentials = dict(urllib.parse.parse_qsl(file_.read().strip()))
+
+    def query(self, s: str, **params):
+        params = dict(page='dapi', s=s, q='index', json='1', **params, **self.credentials)
+        data = self.get(self.ENDPOINT, params=params)
+        if data is None:
+            return None
+        # Newer versions wrap the list, older ones return it bare
+        data = data.get(s, []) if isinstance(data, dict) else data
+        return data if isinstance(data, list) else [data]
+
+    def post(self, data: dict) -> Post:
+        return self.from_tags(data.get('id'), data.get('md5'), data.get('tags', ''), data.get('rating'))
+
+    def get_batch(self, md5s: list) -> dict:
+        posts = self.query('post', tags='md5:' + md5s[0], limit='1')
+        if posts is None:
             return None
+        return {post['md5']: self.post(post) for post in posts if post.get('md5') in md5s}
+
+    def get_from_id(self, id_: int) -> Post:
+        posts = self.query('post', id=str(id_))
+        return self.post(posts[0]) if posts else None
+
+    def get_types(self, tags: list) -> dict:
+        types = {}
+        for i in range(0, len(tags), self.TAG_BATCH):
+            for tag in self.query('tag', names=' '.join(tags[i:i + self.TAG_BATCH])) or []:
+                types[tag.get('name')] = int(tag.get('type', 0))
+        return types
+
+
+class Yandere(TaggedProvider):
+    NAME = 'yandere'
+    ENDPOINT_POSTS = 'https://yande.re/post.json'
+    ENDPOINT_TAGS = 'https://yande.re/tag.json'
+
+    def post(self, data: dict) -> Post:
+        return self.from_tags(data.get('id'), data.get('md5'), data.get('tags', ''), data.get('rating'))
+
+    def get_batch(self, md5s: list) -> dict:
+        posts = self.get(self.ENDPOINT_POSTS, params={'tags': 'md5:' + md5s[0], 'limit': '1'})
+        if not isinstance(posts, list):
+            return None
+        return {post['md5']: self.post(post) for post in posts if post.get('md5') in md5s}
+
+    def get_from_id(self, id_: int) -> Post:
+        posts = self.get(self.ENDPOINT_POSTS, params={'tags': f'id:{id_}', 'limit': '1'})
+        return self.post(posts[0]) if isinstance(posts, list) and posts else None
+
+    def get_types(self, tags: list) -> dict:
+        # Tags can only be asked about one at a time
+        types = {}
+        for tag in tags:
+            for data in self.get(self.ENDPOINT_TAGS, params={'name': tag, 'limit': '0'}) or []:
+                if data.get('name') == tag:
+                    types[tag] = int(data.get('type', 0))
+        return types
+
+
+class Booru:
+    """
+    Resolves posts from the offline index, the cache, then the configured boorus.
+    The first booru is asked first. If it hasn't answered by its usual worst-case time, the 95th percentile of its
+    recent answers, the next one is asked too and whichever finds a post first wins. Posts are handed on as soon as
+    any booru has them, only the hashes still without one wait for the slow booru. Hashes a booru doesn't know fall
+    through to the next one.
+    """
+    PROVIDERS = {i.NAME: i for i in (Danbooru, Safebooru, Gelbooru, Yandere)}
+    BATCH_SIZE = Danbooru.BATCH_SIZE
+    FIELDS = Post._fields
+    # Seconds before asking another booru while too few answers were timed for a percentile
+    HEDGE_AFTER = 2.0
+    MIN_HEDGE_AFTER = 0.25
+    HEDGE_SAMPLES = 20
+    # Answer times kept per booru
+    WINDOW = 200
+
+    def __init__(self, cache=None, offline: bool = False, session: http.Session = None, index=None,
+                 providers: Iterable[str] = ('danbooru',)):
+        self.cache = cache
+        # Local dump index, checked before anything else
+        self.index = index
+        # Answer from the cache only
+        self.offline = offline
+        self.session = session or http.shared()
+        self.providers = [self.PROVIDERS[i](self.session) for i in providers]
+        self.by_name = {i.NAME: i for i in self.providers}
+        self.lock = threading.Lock()
+        self.timings = {i.NAME: collections.deque(maxlen=self.WINDOW) for i in self.providers}
+        self.pool = concurrent.futures.ThreadPoolExecutor(max(4, 4 * len(self.providers)),
+                                                          thread_name_prefix='booru')
+
+    def provider(self, name: str) -> Provider:
+        # Id lookups work on any booru, configured for md5 lookups or not
+        if name not in self.by_name:
+            self.by_name[name] = self.PROVIDERS[name](self.session)
+        return self.by_name[name]
+
+    def hedge_after(self, provider: Provider) -> float:
+        with self.lock:
+            timings = sorted(self.timings[provider.NAME])
+        if len(timings) < self.HEDGE_SAMPLES:
+            return self.HEDGE_AFTER
+        return max(self.MIN_HEDGE_AFTER, timings[int(len(timings) * 0.95)])
+
+    def ask(self, provider: Provider, md5s: list) -> dict:
+        start = time.perf_counter()
+        found = provider.get_from_md5_many(md5s)
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.timings[provider.NAME].append(seconds)
+        metrics.observe('booru_seconds', seconds, booru=provider.NAME)
+        return found
+
+    def lookup(self, md5s: list, on_found: Callable[[str, Post], None] = None) -> tuple:
+        """
+        Ask the boorus for md5s, hedging slow answers. Returns (found, missing), missing are the hashes every booru
+        answered without a post for. Hashes some booru couldn't be asked about are in neither.
+        on_found is called with (md5, post) as each post is found, before slower boorus answered.
+        """
+        found = {}
+        remaining = set(md5s)
+        answered = set()
+        unanswered = set()
+        asked = []
+        pending = {}
+        queue = list(self.providers)
+
+        def launch(hedging: bool) -> bool:
+            while queue:
+                provider = queue.pop(0)
+                # A mirror only helps against a slow or failed answer, it can't know what the original doesn't
+                if not hedging and provider.MIRROR in asked and provider.MIRROR not in unanswered:
+                    continue
+                asked.append(provider.NAME)
+                pending[self.pool.submit(self.ask, provider, sorted(remaining))] = provider, time.monotonic()
+                return True
+            return False
+
+        launch(False)
+        while pending and remaining:
+            # The deadline runs from when the latest booru still waited for was asked, so every further booru waits
+            # out the one before it rather than all being asked at once
+            latest, started = next(reversed(pending.values()))
+            timeout = max(0.0, started + self.hedge_after(latest) - time.monotonic()) if queue else None
+            done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                if launch(True):
+                    metrics.count('booru_hedges_total', booru=latest.NAME)
+                continue
+
+            for future in done:
+                provider, _ = pending.pop(future)
+                try:
+                    posts = future.result()
+                except Exception:
+                    posts = None
+                if posts is None:
+                    unanswered.add(provider.NAME)
+                    continue
+
+                answered.add(provider.NAME)
+                hits = 0
+                for md5, post in posts.items():
+                    if md5 in remaining:
+                        found[md5] = post
+                        remaining.discard(md5)
+                        hits += 1
+                        if on_found is not None:
+                            on_found(md5, post)
+                metrics.count('booru_lookups_total', hits, source=provider.NAME, result='hit')
+
+            for future, (provider, _) in list(pending.items()):
+                if provider.MIRROR in answered:
+                    # The original answered, the mirror can't add anything to it
+                    del pending[future]
+
+            if remaining and not pending:
+                # Misses fall through to the next booru
+                launch(False)
+
+        # A failed mirror doesn't matter once its original answered
+        failed = {i for i in unanswered if self.by_name[i].MIRROR not in answered}
+        missing = remaining if not failed and not pending else set()
+        metrics.count('booru_lookups_total', len(missing), source='boorus', result='miss')
+        return found, missing
+
+    def get_from_md5(self, md5: str) -> list:
+        post = self.get_from_md5_many([md5])[0].get(md5)
+        return [post] if post else []
+
+    def get_from_md5_many(self, md5s: Iterable[str], on_found: Callable[[str, Post], None] = None) -> tuple:
+        """
+        Resolve many hashes with as few requests as possible.
+        Returns (found, unanswered): a dict of md5 -> post for the hashes with a post, and the set of hashes no booru
+        could be asked about, which may well have one. on_found is called with (md5, post) as soon as each post is
+        found, while boorus may still be asked about the rest.
+        """
+        found = {}
+        md5s = sorted(set(md5s))
+        on_found = on_found or (lambda md5, post: None)
+        if self.index:
+            missing = []
+            for md5 in md5s:
+                post = self.index.get(md5)
+                if post:
+                    found[md5] = post
+                    on_found(md5, post)
+                else:
+                    missing.append(md5)
+            metrics.count('booru_lookups_total', len(md5s) - len(missing), source='index', result='hit')
+            md5s = missing
+
+        if self.cache is not None:
+            missing = []
+            for md5 in md5s:
+                post = self.cache.get('md5:' + md5)
+                if post is None:
+                    missing.append(md5)
+                elif post:
+                    found[md5] = post
+                    on_found(md5, post)
+                metrics.count('booru_lookups_total', source='cache',
+                              result='hit' if post else 'miss' if post is not None else 'missing')
+            md5s = missing
+
+        if self.offline or not md5s or not self.providers:
+            return found, set()
+
+        def hit(md5: str, post: Post) -> None:
+            if self.cache is not None:
+                self.cache.put('md5:' + md5, post)
+            on_found(md5, post)
+
+        posts, missing = self.lookup(md5s, hit)
+        found.update(posts)
+        if self.cache is not None:
+            # Only cached as missing once every booru said so
+            for md5 in missing:
+                self.cache.put('md5:' + md5, None)
+
+        return found, set(md5s) - set(posts) - missing
+
+    def get_from_id(self, id_: int, provider: str = 'danbooru') -> Post:
+        key = f'id:{id_}' if provider == 'danbooru' else f'{provider}:id:{id_}'
+        if self.cache is not None:
+            post = self.cache.get(key)
+            metrics.count('booru_lookups_total', source='cache',
+                          result='hit' if post else 'miss' if post is not None else 'missing')
+            if post is not None:
+                return post or None
+        if self.offline:
+            return None
+
+        post = self.provider(provider).get_from_id(id_)
+        metrics.count('booru_lookups_total', source=provider, result='hit' if post else 'miss')
+        if self.cache is not None:
+            self.cache.put(key, post)
+            if post and post.md5:
+                self.cache.put('md5:' + post.md5, post)
+        return post
+
+    def id_lookups(self) -> dict:
+        """
+        Functions looking posts up by the ids SauceNao results carry, keyed by the result field.
+        """
+        return {f'{name}_id': functools.partial(self.get_from_id, provider=name)
+                for name, provider in self.PROVIDERS.items() if provider.MIRROR is None}
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,63 @@
+import time
+
+from .post import Post
+
+
+class BooruCache:
+    """
+    Remembers Danbooru answers between runs, keyed on md5 or post id.
+    Posts are kept as Post records. Misses are stored too and expire after negative_ttl seconds, so a
+    hash that wasn't on Danbooru is asked about again later instead of every run.
+    """
+    # Returned by get() when a cached miss is still fresh
+    MISS = {}
+
+    def __init__(self, database, negative_ttl: float = 7 * 24 * 3600, max_entries: int = 1_000_000):
+        self.database = database
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.database.execute('CREATE TABLE IF NOT EXISTS posts ('
+                              'key TEXT PRIMARY KEY, post TEXT, fetched_at REAL, accessed_at REAL)')
+        self.database.execute('CREATE INDEX IF NOT EXISTS posts_accessed ON posts (accessed_at)')
+
+    def get(self, key: str) -> Post:
+        """
+        Returns the cached post, MISS for a fresh cached miss, or None when the key has to be looked up.
+        """
+        rows = self.database.execute('SELECT post, fetched_at FROM posts WHERE key = ?', (key,))
+        if not rows:
+            return None
+
+        post, fetched_at = rows[0]
+        now = time.time()
+        if post is None and now - fetched_at > self.negative_ttl:
+            return None
+
+        self.database.execute('UPDATE posts SET accessed_at = ? WHERE key = ?', (now, key))
+        self.database.changed()
+        return self.MISS if post is None else Post.from_json(post)
+
+    def put(self, key: str, post: Post) -> None:
+        post = post.to_json() if post else None
+
+        now = time.time()
+        self.database.execute('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)', (key, post, now, now))
+        self.database.changed()
+
+    def evict(self) -> int:
+        """
+        Drop the least recently used entries above max_entries. Returns the number of removed entries.
+        """
+        count = self.database.execute('SELECT COUNT(*) FROM posts')[0][0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+
+        self.database.execute('DELETE FROM posts WHERE key IN '
+                              '(SELECT key FROM posts ORDER BY accessed_at LIMIT ?)', (excess,))
+        self.database.commit()
+        return excess
+
+    def flush(self) -> None:
+        self.evict()
+        self.database.commit()
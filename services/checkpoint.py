@@ -0,0 +1,66 @@
+import collections
+import json
+import os
+import threading
+
+
+class Checkpoint:
+    """
+    Remembers which directories of a multi-directory run are finished, so an interrupted run resumes with the first
+    unfinished one. A directory is finished once it was fully scanned and every file found in it was handled.
+    """
+    PATH = 'checkpoint.json'
+
+    def __init__(self, roots: list, path: str = None, enabled: bool = True):
+        self.path = path or self.PATH
+        self.roots = roots
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.pending = collections.Counter()
+        self.scanned = set()
+        self.done = set()
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file_:
+                    saved = json.load(file_)
+            except ValueError:
+                saved = {}
+            # Only a checkpoint of the same directories can be resumed
+            if saved.get('roots') == roots:
+                self.done = set(saved.get('done', []))
+
+    def add(self, root: str) -> None:
+        with self.lock:
+            self.pending[root] += 1
+
+    def scan_finished(self, root: str) -> None:
+        with self.lock:
+            self.scanned.add(root)
+            self.check(root)
+
+    def finish(self, root: str) -> None:
+        with self.lock:
+            self.pending[root] -= 1
+            self.check(root)
+
+    def check(self, root: str) -> None:
+        if root in self.scanned and self.pending[root] <= 0 and root not in self.done:
+            self.done.add(root)
+            self.save()
+
+    def save(self) -> None:
+        if not self.enabled:
+            return
+
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as file_:
+            json.dump({'roots': self.roots, 'done': [i for i in self.roots if i in self.done]}, file_)
+        os.replace(temp, self.path)
+
+    def complete(self) -> None:
+        """
+        The whole run finished, nothing left to resume.
+        """
+        if self.enabled and os.path.exists(self.path):
+            os.remove(self.path)
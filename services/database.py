@@ -0,0 +1,47 @@
+import sqlite3
+import threading
+
+
+class Database:
+    """
+    Small wrapper around the sqlite file that keeps state between runs.
+    One connection is shared by every store, guarded by a lock so worker threads can use it.
+    """
+    PATH = 'sorter.db'
+    # Writes are committed in batches of this size
+    FLUSH_EVERY = 256
+
+    def __init__(self, path: str = None):
+        self.path = path or self.PATH
+        self.pending = 0
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    def execute(self, sql: str, params=()) -> list:
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def executemany(self, sql: str, params) -> None:
+        with self.lock:
+            self.connection.executemany(sql, params)
+
+    def changed(self) -> None:
+        """
+        Note a write, committing once enough have piled up.
+        """
+        with self.lock:
+            self.pending += 1
+            if self.pending >= self.FLUSH_EVERY:
+                self.commit()
+
+    def commit(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
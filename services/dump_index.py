@@ -0,0 +1,210 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+
+from typing import Iterable, Iterator, Tuple
+
+from .post import Post
+
+
+class Segment:
+    """
+    One immutable, md5-sorted index file, memory-mapped rather than read.
+
+    Layout: header, a fanout table of record counts by the first two md5 bytes (as in git pack indexes),
+    the post data, then fixed-size (md5, offset, length) records sorted by md5.
+    A lookup reads two fanout entries and binary searches the handful of records between them.
+    """
+    MAGIC = b'AISIDX01'
+    HEADER = struct.Struct('<8sQQ')  # magic, record count, records offset
+    FANOUT = struct.Struct('<65537Q')
+    RECORD = struct.Struct('<16sQI')  # md5, data offset, data length
+    DATA_OFFSET = HEADER.size + FANOUT.size
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file_:
+            self.map = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.records = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f'{path} is not an index segment')
+
+    def fanout(self, prefix: int) -> int:
+        return struct.unpack_from('<Q', self.map, self.HEADER.size + prefix * 8)[0]
+
+    def get(self, md5: bytes) -> bytes:
+        prefix = int.from_bytes(md5[:2], 'big')
+        low, high = self.fanout(prefix), self.fanout(prefix + 1)
+        size = self.RECORD.size
+
+        while low < high:
+            middle = (low + high) // 2
+            position = self.records + middle * size
+            key = self.map[position:position + 16]
+            if key < md5:
+                low = middle + 1
+            elif key > md5:
+                high = middle
+            else:
+                _, offset, length = self.RECORD.unpack_from(self.map, position)
+                return self.map[offset:offset + length]
+        return None
+
+    def __iter__(self) -> Iterator[Tuple[bytes, bytes]]:
+        for i in range(self.count):
+            md5, offset, length = self.RECORD.unpack_from(self.map, self.records + i * self.RECORD.size)
+            yield md5, self.map[offset:offset + length]
+
+    def close(self) -> None:
+        self.map.close()
+
+    @classmethod
+    def write(cls, path: str, items: Iterable[Tuple[bytes, bytes]]) -> int:
+        """
+        Write (md5, data) pairs, which must already be sorted by md5 without duplicates, as a new segment.
+        Data is streamed straight to disk and records through a temporary file, so memory use stays flat.
+        """
+        counts = [0] * 65536
+        count = 0
+        temp = path + '.tmp'
+        with open(temp, 'wb') as file_, open(temp + '.records', 'w+b') as records:
+            file_.write(b'\0' * cls.DATA_OFFSET)
+            offset = cls.DATA_OFFSET
+            for md5, data in items:
+                file_.write(data)
+                records.write(cls.RECORD.pack(md5, offset, len(data)))
+                counts[int.from_bytes(md5[:2], 'big')] += 1
+                offset += len(data)
+                count += 1
+
+            records.seek(0)
+            for chunk in iter(lambda: records.read(1024 * 1024), b''):
+                file_.write(chunk)
+
+            fanout = [0]
+            for n in counts:
+                fanout.append(fanout[-1] + n)
+
+            file_.seek(0)
+            file_.write(cls.HEADER.pack(cls.MAGIC, count, offset))
+            file_.write(cls.FANOUT.pack(*fanout))
+            file_.flush()
+            os.fsync(file_.fileno())
+
+        os.remove(temp + '.records')
+        os.replace(temp, path)
+        return count
+
+
+class DumpIndex:
+    """
+    Offline Danbooru metadata built from JSONL post dumps, holding only the fields of a Post.
+    Every import adds new segments instead of rewriting old ones, newer segments win when a post appears twice.
+    compact() merges everything back into a single segment.
+    """
+    PATH = 'dump_index'
+    # Posts sorted in memory before being written out as a segment
+    CHUNK_SIZE = 1_000_000
+
+    # md5 is the key, everything else is stored
+    FIELDS = tuple(i for i in Post._fields if i != 'md5')
+
+    def __init__(self, path: str = None):
+        self.path = path or self.PATH
+        self.segments = []
+        if os.path.isdir(self.path):
+            self.segments = [Segment(os.path.join(self.path, i)) for i in sorted(os.listdir(self.path))
+                             if i.endswith('.idx')]
+
+    def __bool__(self) -> bool:
+        return bool(self.segments)
+
+    def encode(self, post: dict) -> bytes:
+        return '\t'.join('' if post.get(i) is None else str(post.get(i)) for i in self.FIELDS).encode('utf-8')
+
+    def decode(self, md5: str, data: bytes) -> Post:
+        post = dict(zip(self.FIELDS, data.decode('utf-8').split('\t')))
+        post['md5'] = md5
+        return Post.from_dict(post)
+
+    def get(self, md5: str) -> Post:
+        try:
+            key = bytes.fromhex(md5)
+        except ValueError:
+            return None
+
+        # Newest segment first
+        for segment in reversed(self.segments):
+            data = segment.get(key)
+            if data is not None:
+                return self.decode(md5, data)
+        return None
+
+    def next_path(self) -> str:
+        os.makedirs(self.path, exist_ok=True)
+        names = [i for i in os.listdir(self.path) if i.endswith('.idx')]
+        number = max((int(i.split('.')[0]) for i in names), default=0) + 1
+        return os.path.join(self.path, f'{number:06}.idx')
+
+    def add_segment(self, posts: dict) -> None:
+        path = self.next_path()
+        Segment.write(path, sorted(posts.items()))
+        self.segments.append(Segment(path))
+
+    def import_dump(self, path: str) -> int:
+        """
+        Add every post of a JSONL dump. Returns the number of posts imported.
+        """
+        imported = 0
+        posts = {}
+        with open(path, encoding='utf-8') as file_:
+            for line in file_:
+                try:
+                    post = json.loads(line)
+                    md5 = bytes.fromhex(post['md5'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+                posts[md5] = self.encode(post)
+                if len(posts) >= self.CHUNK_SIZE:
+                    self.add_segment(posts)
+                    imported += len(posts)
+                    posts = {}
+
+        if posts:
+            self.add_segment(posts)
+            imported += len(posts)
+        return imported
+
+    def compact(self) -> int:
+        """
+        Merge all segments into one. Returns the number of posts kept.
+        """
+        if len(self.segments) < 2:
+            return sum(i.count for i in self.segments)
+
+        def tagged(segment: Segment, n: int) -> Iterator[Tuple[bytes, int, bytes]]:
+            # A function of its own, so every stream keeps its own n
+            for md5, data in segment:
+                yield md5, -n, data
+
+        def merged():
+            last = None
+            # Newer segments sort first on equal md5s, so the first of each md5 is the one to keep
+            streams = [tagged(segment, n) for n, segment in enumerate(self.segments)]
+            for md5, _, data in heapq.merge(*streams):
+                if md5 != last:
+                    last = md5
+                    yield md5, data
+
+        path = self.next_path()
+        count = Segment.write(path, merged())
+
+        for segment in self.segments:
+            segment.close()
+            os.remove(segment.path)
+        self.segments = [Segment(path)]
+        return count
@@ -0,0 +1,211 @@
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import os
+import shutil
+import threading
+
+from . import metrics
+from .prompts import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+Op = collections.namedtuple('Op', 'kind src dst')
+
+MKDIR = 'mkdir'
+RENAME = 'rename'
+COPY = 'copy'
+SYMLINK = 'symlink'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+REMOVE = 'remove'
+SHARE = 'share'
+
+VERBS = {
+    MKDIR: 'Creating',
+    RENAME: 'Moving',
+    COPY: 'Copying',
+    SYMLINK: 'Linking',
+    HARDLINK: 'Hard linking',
+    REFLINK: 'Reflinking',
+    REMOVE: 'Removing',
+    SHARE: 'Sharing',
+}
+
+# ioctl asking the filesystem to share src's extents with dst (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Reasons a hard link can't be made where a copy still can
+NO_LINK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+# Not every platform can create files relative to a directory descriptor
+DIR_FD = os.open in os.supports_dir_fd and os.link in os.supports_dir_fd
+
+
+def same_file(src: str, dst: str) -> bool:
+    """
+    Whether dst already is src, or a hard link to it. A symlink at dst is a different file.
+    """
+    try:
+        return os.path.samestat(os.stat(src), os.lstat(dst))
+    except OSError:
+        return False
+
+
+class FileOperations:
+    """
+    Runs the operations planned for each file on a thread pool.
+    A file's operations run in order, different files run side by side. Directories are only created once per run,
+    and files are created relative to a descriptor of their folder rather than by changing the working directory.
+    """
+    def __init__(self, workers: int = 4, dry_run: bool = False):
+        self.dry_run = dry_run
+        self.pool = concurrent.futures.ThreadPoolExecutor(max(1, workers), thread_name_prefix='file-op')
+        self.lock = threading.Lock()
+        self.directories = set()
+
+    def submit(self, ops: list, callback=None, after: concurrent.futures.Future = None) -> concurrent.futures.Future:
+        """
+        Queue a file's operations. callback is called without arguments once they have run, or failed.
+        after is the future of earlier operations these have to wait for, such as the ones placing a file they link to.
+        Returns a future done once the operations have run, None on dry runs.
+        """
+        if self.dry_run:
+            log(*(f'{ACTION_PROMPT}[Dry run] {op.kind} {op.src} -> {op.dst}' if op.src else
+                  f'{ACTION_PROMPT}[Dry run] {op.kind} {op.dst}' for op in ops))
+            if callback:
+                callback()
+            return None
+
+        future = self.pool.submit(self.run, ops, after)
+        future.add_done_callback(lambda done: self.done(done, callback))
+        return future
+
+    @staticmethod
+    def done(future: concurrent.futures.Future, callback=None) -> None:
+        if future.exception() is not None:
+            log(f'{ERROR_PROMPT}File operation failed: {future.exception()}', important=True)
+            metrics.count('file_operation_errors_total')
+        if callback:
+            callback()
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+
+    def run(self, ops: list, after: concurrent.futures.Future = None) -> None:
+        if after is not None:
+            # Queued earlier, so it is already running on another worker or done
+            concurrent.futures.wait([after])
+        for op in ops:
+            if op.kind == MKDIR:
+                self.mkdir(op.dst)
+                continue
+
+            preposition = 'from' if op.kind == REMOVE else 'to'
+            log(f'{ACTION_PROMPT}{VERBS[op.kind]} {os.path.basename(op.dst)} {preposition} {os.path.dirname(op.dst)}')
+            with metrics.timer('file_operation_seconds', kind=op.kind):
+                getattr(self, op.kind)(op.src, op.dst)
+            metrics.count('file_operations_total', kind=op.kind)
+
+    def mkdir(self, path: str) -> None:
+        # Created under the lock, so no other file can see the folder as done before it exists
+        with self.lock:
+            if path not in self.directories:
+                os.makedirs(path, exist_ok=True)
+                self.directories.add(path)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def at(path: str):
+        """
+        Yields (dir_fd, name) for path, or (None, path) where descriptors aren't supported.
+        """
+        if not DIR_FD:
+            yield None, path
+            return
+
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        try:
+            yield fd, os.path.basename(path)
+        finally:
+            os.close(fd)
+
+    def rename(self, src: str, dst: str) -> None:
+        with self.at(dst) as (fd, name):
+            os.replace(src, name, dst_dir_fd=fd)
+
+    def symlink(self, src: str, dst: str) -> None:
+        with self.at(dst) as (fd, name):
+            if not self.exists(fd, name):
+                os.symlink(src, name, dir_fd=fd)
+                return
+        # src is relative to the link's folder
+        self.taken(os.path.join(os.path.dirname(dst), src), dst)
+
+    def hardlink(self, src: str, dst: str) -> None:
+        with self.at(dst) as (fd, name):
+            if not self.exists(fd, name):
+                os.link(src, name, dst_dir_fd=fd)
+                return
+        self.taken(src, dst)
+
+    @staticmethod
+    def taken(src: str, dst: str) -> None:
+        # Already linked on an earlier run is fine, a different file there is left alone but not kept quiet about
+        try:
+            if os.path.samefile(src, dst):
+                return
+        except OSError:
+            pass
+        raise FileExistsError(errno.EEXIST, 'A different file is already there', dst)
+
+    def share(self, src: str, dst: str) -> None:
+        # src is an identical file placed earlier, hard linked where possible rather than copied again
+        try:
+            self.hardlink(src, dst)
+        except OSError as e:
+            if e.errno not in NO_LINK:
+                raise
+            self.copy(src, dst)
+
+    def remove(self, src: str, dst: str) -> None:
+        with self.at(dst) as (fd, name):
+            try:
+                os.unlink(name, dir_fd=fd)
+            except FileNotFoundError:
+                pass
+
+    def copy(self, src: str, dst: str) -> None:
+        self.write(src, dst, clone=False)
+
+    def reflink(self, src: str, dst: str) -> None:
+        self.write(src, dst, clone=True)
+
+    def write(self, src: str, dst: str, clone: bool) -> None:
+        # Opening dst would truncate src before a byte of it was read
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            raise shutil.SameFileError(f'{src} and {dst} are the same file')
+        with self.at(dst) as (fd, name):
+            opener = (lambda path, flags: os.open(path, flags, 0o666, dir_fd=fd)) if fd is not None else None
+            with open(src, 'rb') as source, open(name, 'wb', opener=opener) as target:
+                if clone and fcntl is not None:
+                    try:
+                        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                        return
+                    except OSError:
+                        # Filesystem can't share extents, fall back to copying bytes
+                        pass
+                shutil.copyfileobj(source, target, 1024 * 1024)
+
+    @staticmethod
+    def exists(fd: int, name: str) -> bool:
+        try:
+            os.stat(name, dir_fd=fd, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        return True
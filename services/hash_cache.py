@@ -0,0 +1,63 @@
+import os
+
+
+class HashCache:
+    """
+    Remembers file hashes between runs.
+    Entries are keyed on (device, inode, size, mtime_ns), so an unchanged file is never hashed twice and a moved or
+    renamed file keeps its entry.
+    """
+    def __init__(self, database):
+        self.database = database
+        self.database.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                              'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+                              'path TEXT, md5 TEXT, '
+                              'PRIMARY KEY (device, inode, size, mtime_ns))')
+
+    @staticmethod
+    def key(stat: os.stat_result) -> tuple:
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, path: str, stat: os.stat_result) -> str:
+        path = os.path.abspath(path)
+        rows = self.database.execute('SELECT path, md5 FROM hashes '
+                                     'WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?', self.key(stat))
+        if not rows:
+            return None
+
+        old_path, md5 = rows[0]
+        if old_path != path:
+            self.database.execute('UPDATE hashes SET path = ? '
+                                  'WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                                  (path,) + self.key(stat))
+            self.database.changed()
+        return md5
+
+    def put(self, path: str, stat: os.stat_result, md5: str) -> None:
+        path = os.path.abspath(path)
+        self.database.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                              self.key(stat) + (path, md5))
+        self.database.changed()
+
+    def flush(self) -> None:
+        self.database.commit()
+
+    def prune(self) -> int:
+        """
+        Drop entries whose file no longer exists or has changed since it was hashed.
+        Returns the number of removed entries.
+        """
+        stale = []
+        for device, inode, size, mtime_ns, path in self.database.execute(
+                'SELECT device, inode, size, mtime_ns, path FROM hashes'):
+            try:
+                current = self.key(os.stat(path))
+            except OSError:
+                current = None
+            if current != (device, inode, size, mtime_ns):
+                stale.append((device, inode, size, mtime_ns))
+
+        self.database.executemany('DELETE FROM hashes '
+                                  'WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?', stale)
+        self.flush()
+        return len(stale)
@@ -0,0 +1,126 @@
+import concurrent.futures
+import hashlib
+import os
+import signal
+import time
+
+from typing import Callable, Iterable, Iterator, Tuple, Union
+
+from . import metrics
+from .prompts import *
+
+
+# Files are hashed in chunks of this size so large GIFs never sit in memory whole
+CHUNK_SIZE = 1024 * 1024
+
+
+def md5_file(path: str) -> str:
+    hsh = hashlib.md5()
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(CHUNK_SIZE), b''):
+            hsh.update(chunk)
+    return hsh.hexdigest().lower()
+
+
+def ignore_interrupts() -> None:
+    """
+    Pool worker initializer. Ctrl+C reaches the whole process group, only the main process should handle it.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def timed_md5_file(path: str) -> Tuple[str, float]:
+    # Timed in the worker, so the time spent queued for the pool isn't counted
+    start = time.perf_counter()
+    md5 = md5_file(path)
+    return md5, time.perf_counter() - start
+
+
+class Hasher:
+    """
+    The process pool is started on first use and kept until close(), so repeated calls don't pay for it again.
+    """
+    def __init__(self, workers: int = None, cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        # Number of files handed to the pool ahead of the consumer
+        self.in_flight = self.workers * 4
+        self.pool = None
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def hash_files(self, paths: Iterable[Union[str, os.DirEntry]],
+                   known: Callable[[str], str] = None) -> Iterator[Tuple[str, str]]:
+        """
+        Hash paths across a process pool, yielding (path, md5) as each digest finishes, (path, None) for files that
+        vanished or couldn't be read. paths is consumed lazily, so hashing starts before the caller has listed everything.
+        Files found in the cache cost a single stat() and are yielded without being read, DirEntries reuse the stat
+        data from listing. known may give a hash for a path without reading it at all.
+        """
+        paths = iter(paths)
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=ignore_interrupts)
+        pool = self.pool
+        pending = {}
+        ready = []
+
+        def fill():
+            for path in paths:
+                entry, path = path, os.fspath(path)
+                md5 = known(path) if known else None
+                if md5:
+                    metrics.count('files_hashed_total', source='filename')
+                    ready.append((path, md5))
+                    if len(ready) >= self.in_flight:
+                        break
+                    continue
+
+                stat = None
+                if self.cache is not None:
+                    try:
+                        stat = entry.stat() if isinstance(entry, os.DirEntry) else os.stat(path)
+                    except OSError:
+                        # Gone since it was listed
+                        ready.append((path, None))
+                        continue
+                    md5 = self.cache.get(path, stat)
+                    if md5:
+                        metrics.count('files_hashed_total', source='cache')
+                        ready.append((path, md5))
+                        if len(ready) >= self.in_flight:
+                            break
+                        continue
+
+                pending[pool.submit(timed_md5_file, path)] = path, stat
+                if len(pending) >= self.in_flight:
+                    break
+
+        fill()
+        while pending or ready:
+            yield from ready
+            ready.clear()
+
+            if pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    path, stat = pending.pop(future)
+                    try:
+                        md5, seconds = future.result()
+                    except OSError as e:
+                        log(f'{ERROR_PROMPT}Could not read {path}: {e}')
+                        yield path, None
+                        continue
+                    metrics.observe('stage_seconds', seconds, stage='Hashing')
+                    metrics.count('files_hashed_total', source='read')
+                    if stat is not None:
+                        metrics.count('bytes_hashed_total', stat.st_size)
+                    if self.cache is not None:
+                        self.cache.put(path, stat, md5)
+                    yield path, md5
+            fill()
+
+        if self.cache is not None:
+            self.cache.flush()
@@ -0,0 +1,40 @@
+import io
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+
+def available() -> bool:
+    return numpy is not None and Image is not None
+
+
+def thumbnail(path: str, size: int = 360, quality: int = 80) -> bytes:
+    """
+    JPEG preview no larger than size pixels on its long edge, plenty for a reverse image search.
+    """
+    with Image.open(path) as image:
+        image.draft('RGB', (size, size))
+        image = image.convert('RGB')
+        image.thumbnail((size, size), Image.LANCZOS)
+
+    data = io.BytesIO()
+    image.save(data, 'JPEG', quality=quality)
+    return data.getvalue()
+
+
+def dhash(path: str, size: int = 8) -> int:
+    """
+    Difference hash: shrink to (size + 1) x size greyscale and record whether each pixel is brighter than its left
+    neighbour. Re-encodes, resizes and recompressions of an image keep (almost) the same bits.
+    """
+    with Image.open(path) as image:
+        # Lets JPEG decode at a fraction of the full size
+        image.draft('L', (size * 8, size * 8))
+        pixels = numpy.asarray(image.convert('L').resize((size + 1, size), Image.LANCZOS), dtype=numpy.int16)
+
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
@@ -0,0 +1,50 @@
+import collections
+import json
+import os
+
+from typing import Iterator
+
+from .post import Post
+
+Entry = collections.namedtuple('Entry', 'root filename md5 post source paths found')
+
+
+class Manifest:
+    """
+    Every identified file with the post it was identified by and the paths sorting gave it.
+    Enough to lay the library out again under other settings without hashing or asking Danbooru anything.
+
+    found is where the file was found and tells entries apart, as images of the same name can be found in different
+    folders. source is the same path, or None once the file was moved away. paths are the files sorting created,
+    symlinks included. Everything is stored as absolute paths.
+    """
+    # Rows read per query while walking a root, so huge libraries are never loaded at once
+    PAGE_SIZE = 1000
+
+    def __init__(self, database):
+        self.database = database
+        self.database.execute('CREATE TABLE IF NOT EXISTS manifest ('
+                              'found TEXT PRIMARY KEY, root TEXT, filename TEXT, md5 TEXT, post TEXT, source TEXT, '
+                              'paths TEXT)')
+        self.database.execute('CREATE INDEX IF NOT EXISTS manifest_root ON manifest (root, found)')
+
+    def put(self, root: str, filename: str, md5: str, post: Post, source: str, paths: list, found: str) -> None:
+        source = os.path.abspath(source) if source else None
+        paths = json.dumps([os.path.abspath(i) for i in paths])
+        self.database.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (os.path.abspath(found), os.path.abspath(root), filename, md5, post.to_json(), source,
+                               paths))
+        self.database.changed()
+
+    def entries(self, root: str) -> Iterator[Entry]:
+        root = os.path.abspath(root)
+        last = ''
+        while True:
+            rows = self.database.execute('SELECT found, filename, md5, post, source, paths FROM manifest '
+                                         'WHERE root = ? AND found > ? ORDER BY found LIMIT ?',
+                                         (root, last, self.PAGE_SIZE))
+            for found, filename, md5, post, source, paths in rows:
+                yield Entry(root, filename, md5, Post.from_json(post), source, json.loads(paths), found)
+            if len(rows) < self.PAGE_SIZE:
+                return
+            last = rows[-1][0]
@@ -0,0 +1,227 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+from .prompts import *
+
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+PREFIX = 'sorter_'
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        # The last count is everything above the largest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating inside its bucket, as Prometheus' histogram_quantile() does.
+        """
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.buckets[i - 1] if i else 0.0
+                high = min(self.buckets[i] if i < len(self.buckets) else self.max, self.max)
+                return low + (max(high, low) - low) * (rank - seen) / n
+            seen += n
+        return self.max
+
+
+class Metrics:
+    """
+    Counters and timing histograms, both keyed by name and labels. Safe to update from any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def total(self, name: str, **labels) -> float:
+        """
+        Sum of a counter over every label set containing labels.
+        """
+        wanted = set(self.key(name, labels)[1])
+        with self.lock:
+            return sum(value for (counter, counter_labels), value in self.counters.items()
+                       if counter == name and wanted <= set(counter_labels))
+
+    @staticmethod
+    def labels(labels: tuple, **extra) -> str:
+        labels = labels + tuple(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def prometheus(self) -> str:
+        """
+        Everything in Prometheus' text exposition format.
+        """
+        lines = []
+        last = None
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != last:
+                    lines.append(f'# TYPE {PREFIX}{name} counter')
+                    last = name
+                lines.append(f'{PREFIX}{name}{self.labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda i: i[0]):
+                if name != last:
+                    lines.append(f'# TYPE {PREFIX}{name} histogram')
+                    last = name
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    lines.append(f'{PREFIX}{name}_bucket{self.labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{PREFIX}{name}_bucket{self.labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{PREFIX}{name}_sum{self.labels(labels)} {histogram.sum}')
+                lines.append(f'{PREFIX}{name}_count{self.labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """
+        Counters and histogram percentiles as plain dicts, grouped by name then by label string.
+        """
+        summary = {'uptime': time.time() - self.started, 'counters': {}, 'histograms': {}}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                summary['counters'].setdefault(name, {})[self.labels(labels)] = value
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda i: i[0]):
+                summary['histograms'].setdefault(name, {})[self.labels(labels)] = {
+                    'count': histogram.count, 'sum': histogram.sum, 'max': histogram.max,
+                    'p50': histogram.quantile(0.5), 'p90': histogram.quantile(0.9), 'p99': histogram.quantile(0.99),
+                }
+        return summary
+
+
+class Reporter:
+    """
+    Calls report() every interval seconds on a background thread, and once more on close().
+    """
+    def __init__(self, metrics: Metrics, interval: float):
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+
+    def start(self) -> 'Reporter':
+        self.thread.start()
+        return self
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report()
+
+
+class Exporter(Reporter):
+    """
+    Writes the metrics to path, as JSON if it ends in .json and in Prometheus' text format otherwise,
+    so a node_exporter textfile collector can pick it up.
+    """
+    def __init__(self, metrics: Metrics, path: str, interval: float = 30.0):
+        super().__init__(metrics, interval)
+        self.path = path
+
+    def report(self) -> None:
+        if self.path.endswith('.json'):
+            data = json.dumps(self.metrics.summary(), indent=2)
+        else:
+            data = self.metrics.prometheus()
+
+        # Written aside and renamed, so a reader never sees half a file
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as file_:
+            file_.write(data)
+        os.replace(temp, self.path)
+
+
+class Progress(Reporter):
+    """
+    A single progress line standing in for the per-file output.
+    """
+    def __init__(self, metrics: Metrics, interval: float = 1.0):
+        super().__init__(metrics, interval)
+        self.tty = sys.stdout.isatty()
+
+    def report(self) -> None:
+        total = self.metrics.total
+        done = total('images_total')
+        elapsed = max(time.time() - self.metrics.started, 1e-9)
+        line = (f'{MINOR_PROMPT}{total("files_scanned_total"):.0f} found, {total("files_hashed_total"):.0f} hashed, '
+                f'{total("images_total", result="placed"):.0f} sorted, '
+                f'{total("images_total", result="unknown"):.0f} unknown, {done / elapsed:.1f} images/s, '
+                f'{total("rate_limit_sleep_seconds_total"):.0f}s waiting on rate limits')
+        with print_lock:
+            if self.tty:
+                print('\r\033[K' + line, end='' if not self.stopped.is_set() else '\n', flush=True)
+            else:
+                print(line, flush=True)
+
+
+_shared = Metrics()
+
+
+def shared() -> Metrics:
+    return _shared
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    _shared.count(name, value, **labels)
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    _shared.observe(name, seconds, **labels)
+
+
+def timer(name: str, **labels):
+    return _shared.timer(name, **labels)
@@ -0,0 +1,90 @@
+import threading
+
+from .post import Post
+
+
+class NearDuplicateIndex:
+    """
+    Perceptual hashes of identified images, searched by Hamming distance with multi-index hashing.
+    Each 64 bit hash is split into four 16 bit chunks with a table per chunk. Two hashes within distance d share at
+    least one chunk that differs in at most d // 4 bits, so only those chunk values need probing.
+    Hashes are kept in memory, posts stay in sorter.db until a match needs one.
+    """
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self, database, threshold: int = 4):
+        self.database = database
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.hashes = []
+        self.md5s = []
+        self.tables = [{} for _ in range(self.CHUNKS)]
+
+        self.database.execute('CREATE TABLE IF NOT EXISTS phashes (md5 TEXT PRIMARY KEY, hash INTEGER, post TEXT)')
+        for md5, hsh in self.database.execute('SELECT md5, hash FROM phashes'):
+            self.index(md5, hsh % 2 ** 64)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def chunks(self, hsh: int):
+        mask = 2 ** self.CHUNK_BITS - 1
+        return [(hsh >> (i * self.CHUNK_BITS)) & mask for i in range(self.CHUNKS)]
+
+    def index(self, md5: str, hsh: int) -> None:
+        n = len(self.hashes)
+        self.hashes.append(hsh)
+        self.md5s.append(md5)
+        for table, chunk in zip(self.tables, self.chunks(hsh)):
+            table.setdefault(chunk, []).append(n)
+
+    def add(self, md5: str, hsh: int, post: Post) -> None:
+        with self.lock:
+            if self.database.execute('SELECT 1 FROM phashes WHERE md5 = ?', (md5,)):
+                return
+
+            # sqlite integers are signed
+            signed = hsh - 2 ** 64 if hsh >= 2 ** 63 else hsh
+            self.database.execute('INSERT INTO phashes VALUES (?, ?, ?)', (md5, signed, post.to_json()))
+            self.database.changed()
+            self.index(md5, hsh)
+
+    def probes(self, chunk: int, flips: int):
+        """
+        Every chunk value within flips bits of chunk.
+        """
+        values = {chunk}
+        for _ in range(flips):
+            values |= {value ^ (1 << bit) for value in values for bit in range(self.CHUNK_BITS)}
+        return values
+
+    def nearest(self, hsh: int) -> tuple:
+        """
+        Returns (distance, md5) of the closest hash within the threshold, or None.
+        """
+        flips = self.threshold // self.CHUNKS
+        best = None
+        seen = set()
+        with self.lock:
+            for table, chunk in zip(self.tables, self.chunks(hsh)):
+                for probe in self.probes(chunk, flips):
+                    for n in table.get(probe, ()):
+                        if n in seen:
+                            continue
+                        seen.add(n)
+                        distance = bin(self.hashes[n] ^ hsh).count('1')
+                        if distance <= self.threshold and (best is None or distance < best[0]):
+                            best = distance, self.md5s[n]
+        return best
+
+    def get(self, hsh: int) -> Post:
+        """
+        Post of the closest identified image, or None if nothing is close enough.
+        """
+        best = self.nearest(hsh)
+        if best is None:
+            return None
+
+        rows = self.database.execute('SELECT post FROM phashes WHERE md5 = ?', (best[1],))
+        return Post.from_json(rows[0][0]) if rows else None
@@ -0,0 +1,82 @@
+import queue
+import threading
+import time
+import traceback
+
+from . import metrics
+from .prompts import *
+
+
+class Stage:
+    """
+    A pool of worker threads fed by a bounded queue.
+    put() blocks while the queue is full, so a slow stage holds back the ones feeding it instead of piling up work.
+    """
+    STOP = object()
+
+    def __init__(self, name: str, handler, workers: int = 1, maxsize: int = None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize or self.workers * 4)
+        self.threads = [threading.Thread(target=self.run, name=f'{name}-{i}', daemon=True)
+                        for i in range(self.workers)]
+
+    def start(self) -> 'Stage':
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def put(self, item) -> None:
+        self.queue.put(item)
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is self.STOP:
+                self.queue.task_done()
+                return
+
+            start = time.perf_counter()
+            try:
+                self.handler(item)
+            except Exception:
+                log(f'{ERROR_PROMPT}{self.name} failed on {item!r}:', traceback.format_exc().rstrip(), important=True)
+            metrics.observe('stage_seconds', time.perf_counter() - start, stage=self.name)
+            self.queue.task_done()
+
+    def join(self) -> None:
+        """
+        Wait for everything queued so far to be handled, leaving the workers running.
+        """
+        self.queue.join()
+
+    def close(self) -> None:
+        """
+        Wait for everything queued so far to be handled, then stop the workers.
+        """
+        for _ in self.threads:
+            self.queue.put(self.STOP)
+        for thread in self.threads:
+            thread.join()
+
+
+class Pipeline:
+    """
+    Stages listed in the order work flows through them.
+    Stages are closed in that order, so a stage only stops once every stage feeding it has finished.
+    """
+    def __init__(self, *stages: Stage):
+        self.stages = stages
+
+    def __enter__(self) -> 'Pipeline':
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        if exc_type is not None:
+            # Interrupted, the daemon workers are left to die with the process
+            return
+        for stage in self.stages:
+            stage.close()
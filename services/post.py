@@ -0,0 +1,35 @@
+import collections
+import json
+import sys
+
+
+class Post(collections.namedtuple('Post', 'id md5 tag_string_character tag_count_character '
+                                          'tag_string_copyright tag_count_copyright rating')):
+    """
+    The Danbooru post fields sorting reads, and the only ones requested, cached, indexed or kept in the manifest.
+    Tag strings are interned, so the many posts sharing a series or character share a single string.
+    """
+    __slots__ = ()
+
+    INT_FIELDS = ('id', 'tag_count_character', 'tag_count_copyright')
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Post':
+        values = []
+        for field in cls._fields:
+            value = data.get(field)
+            if field in cls.INT_FIELDS:
+                # Dumps hold every field as text, missing ones as empty strings
+                values.append(int(value) if value not in (None, '') else None if field == 'id' else 0)
+            elif field == 'md5':
+                values.append(value)
+            else:
+                values.append(sys.intern(str(value or '')))
+        return cls._make(values)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'Post':
+        return cls.from_dict(dict(zip(cls._fields, json.loads(text))))
+
+    def to_json(self) -> str:
+        return json.dumps(list(self), separators=(',', ':'))
@@ -1,3 +1,4 @@
+import threading
 import sys
 import os
 
@@ -30,3 +31,24 @@ if sys.stdout.isatty() and os.name != 'nt':
 
     NOT_FOUND = '\033[0;31m[Not found]'
     OKAY = '\033[0;34m[Okay]'
+
+
+print_lock = threading.Lock()
+# Set by --quiet, per-file lines are left out and a progress line is shown instead
+quiet = False
+
+
+def set_quiet(value: bool) -> None:
+    global quiet
+    quiet = value
+
+
+def log(*lines: str, important: bool = False) -> None:
+    """
+    Print whole lines at once, so output from worker threads doesn't interleave.
+    Only important lines are printed in quiet mode.
+    """
+    if quiet and not important:
+        return
+    with print_lock:
+        print('\n'.join(lines), flush=True)
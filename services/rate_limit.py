@@ -0,0 +1,144 @@
+import threading
+import time
+import urllib.parse
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised instead of waiting when the next token is further away than the limiter is willing to wait.
+    """
+    def __init__(self, host: str, bucket: str, wait: float):
+        super().__init__(f'{host} {bucket} limit reached, next request allowed in {wait:.0f}s')
+        self.host = host
+        self.bucket = bucket
+        self.wait = wait
+
+
+class TokenBucket:
+    def __init__(self, limit: int, period: float):
+        self.capacity = limit
+        self.rate = limit / period
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """
+        Take a token, returning how long the caller has to wait before it may use it.
+        Tokens may go negative, so concurrent callers queue up behind each other instead of racing.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= 1
+            return max(self.blocked_until - now, -self.tokens / self.rate, 0.0)
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.tokens += 1
+
+    def observe(self, remaining: int, reset_in: float = None) -> None:
+        """
+        Correct the bucket from what the server reported. The server is only trusted when it is stricter than us,
+        since requests already in flight aren't counted in its answer yet.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and reset_in:
+                self.blocked_until = max(self.blocked_until, now + reset_in)
+
+    def block(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Token buckets per host, seeded from known limits and corrected from what each response reports.
+    Workers wait on a token before every request, so they can run right up to the allowed rate.
+    """
+    # host -> bucket name -> (requests, per seconds)
+    LIMITS = {
+        'danbooru.donmai.us': {'requests': (10, 1)},
+        'safebooru.donmai.us': {'requests': (10, 1)},
+        'gelbooru.com': {'requests': (5, 1)},
+        'yande.re': {'requests': (5, 1)},
+        'saucenao.com': {'short': (20, 30), 'long': (300, 24 * 3600)},
+        'api.imgur.com': {'user': (500, 3600), 'client': (12500, 24 * 3600), 'post': (1250, 3600)},
+    }
+    # remaining header -> (bucket name, reset header)
+    HEADERS = {
+        'X-RateLimit-Remaining': ('requests', 'X-RateLimit-Reset'),
+        'X-RateLimit-UserRemaining': ('user', 'X-RateLimit-UserReset'),
+        'X-RateLimit-ClientRemaining': ('client', None),
+        'X-Post-Rate-Limit-Remaining': ('post', 'X-Post-Rate-Limit-Reset'),
+    }
+
+    def __init__(self, limits: dict = None, max_wait: float = 3600.0):
+        self.limits = limits or self.LIMITS
+        self.max_wait = max_wait
+        self.buckets = {
+            host: {name: TokenBucket(*limit) for name, limit in buckets.items()}
+            for host, buckets in self.limits.items()
+        }
+
+    @staticmethod
+    def host(url: str) -> str:
+        return urllib.parse.urlsplit(url).hostname or url
+
+    def acquire(self, url: str) -> float:
+        """
+        Wait until every bucket of the url's host allows a request. Returns the time spent waiting.
+        """
+        host = self.host(url)
+        waited = 0.0
+        for name, bucket in self.buckets.get(host, {}).items():
+            wait = bucket.reserve()
+            if wait > self.max_wait:
+                bucket.cancel()
+                raise RateLimitExceeded(host, name, wait)
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+        return waited
+
+    @staticmethod
+    def reset_in(value) -> float:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        # Some hosts send an epoch timestamp, others a number of seconds
+        return value - time.time() if value > 1e9 else value
+
+    def observe(self, url: str, bucket: str, remaining, reset_in: float = None) -> None:
+        bucket = self.buckets.get(self.host(url), {}).get(bucket)
+        if bucket is None:
+            return
+        try:
+            bucket.observe(int(remaining), reset_in)
+        except (TypeError, ValueError):
+            pass
+
+    def update(self, url: str, headers) -> None:
+        """
+        Correct the host's buckets from rate limit headers of a response.
+        """
+        for header, (bucket, reset_header) in self.HEADERS.items():
+            if header in headers:
+                reset_in = self.reset_in(headers.get(reset_header)) if reset_header else None
+                self.observe(url, bucket, headers[header], reset_in)
+
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            seconds = self.reset_in(retry_after)
+            if seconds:
+                for bucket in self.buckets.get(self.host(url), {}).values():
+                    bucket.block(seconds)
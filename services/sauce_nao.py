@@ -1,7 +1,10 @@
 ﻿import requests
-import time
 
+from . import metrics
+from . import session as http
+from .post import Post
 from .prompts import *
+from .rate_limit import RateLimitExceeded
 
 
 proxies = {'https': open('keys/proxy.txt').read()} if os.path.exists('keys/proxy.txt') else {}
@@ -20,12 +23,21 @@ class SauceNaoResult:
 
 
 class SauceNao:
+    """
+    With a quota, callers reserve() each search before uploading anything for it. Reservations beyond the quota, and
+    searches SauceNao refuses for being over its daily limit, raise RateLimitExceeded.
+    """
     ENDPOINT = 'https://saucenao.com/search.php'
     KEY_FILE = 'keys/sauceNaoApiKey.txt'
+    # A 429 is SauceNao's daily limit as often as its 30 second one, the answer says which
+    RETRY_STATUSES = http.Session.RETRY_STATUSES - {429}
 
-    def __init__(self):
-        self.remaining_sauces = 2 ** 16
-        self.remaining_sauces_long = 2 ** 16
+    def __init__(self, session: http.Session = None, quota=None):
+        self.session = session or http.shared()
+        self.quota = quota
+        if quota is not None:
+            # Whatever earlier runs left, rather than a full day's worth
+            self.session.limiter.observe(self.ENDPOINT, 'long', quota.available(), quota.reset_in())
 
         try:
             with open(self.KEY_FILE) as file_:
@@ -34,43 +46,137 @@ class SauceNao:
             print(f'\n{MAJOR_PROMPT}SauceNao API key missing. Aborting.')
             quit()
 
-    @classmethod
-    def get(cls, url, params=None, retry=240):
-        r = requests.get(url, proxies=proxies, params=params)
+    def reserve(self) -> None:
+        if self.quota is not None and not self.quota.spend():
+            raise RateLimitExceeded(self.session.limiter.host(self.ENDPOINT), 'daily', self.quota.reset_in())
 
-        if r.status_code == 429:
-            ra = int(r.headers.get('Retry-After', retry))
-            print(f'[ Sleeping for {ra}s ]', end=' ', flush=True)
-            time.sleep(ra)
-            ra *= 2
+    def refund(self) -> None:
+        # A reserved search that was never made
+        if self.quota is not None:
+            self.quota.refund()
 
-            return cls.get(url, params=params, retry=ra)
+    def search(self, method: str, **kwargs) -> SauceNaoResult:
+        try:
+            r = self.session.request(method, self.ENDPOINT, retry_statuses=self.RETRY_STATUSES, proxies=proxies,
+                                     **kwargs)
+        except RateLimitExceeded:
+            self.refund()
+            raise
+        return self.parse(r)
 
-        return r
+    def params(self) -> dict:
+        return {'db': '999', 'output_type': '2', 'numres': '16', 'api_key': self.api_key}
 
     def request(self, url: str) -> SauceNaoResult:
-        # Ratelimits
-        if self.remaining_sauces < 2:
-            print(f'\n{ERROR_PROMPT}Too many Sauces, approaching SauceNao 20 requests per 30s limit.'
-                  f'Waiting 30s.')
-            time.sleep(30)
-        if self.remaining_sauces_long < 2:
-            print(f'\n{ERROR_PROMPT}Too many Sauces, approaching SauceNao 300 requests per 24hrs limit.'
-                  f'Monitor your usage at https://saucenao.com/user.php?page=search-usage and start again.')
-            quit()
+        # Waiting on the 30s and 24h limits is left to the session's rate limiter
+        params = self.params()
+        params['url'] = url
 
-        params = {'db': '999', 'output_type': '2',
-                  'numres': '16', 'api_key': self.api_key, 'url': url}
+        return self.search('GET', params=params)
 
-        r = self.get(self.ENDPOINT, params=params)
+    def request_file(self, data: bytes, name: str = 'thumbnail.jpg') -> SauceNaoResult:
+        """
+        Search by uploading the image itself, best a small thumbnail, instead of passing an image host url.
+        """
+        files = {'file': (name, data, 'image/jpeg')}
+        metrics.count('bytes_uploaded_total', len(data), host='SauceNao')
+        return self.search('POST', params=self.params(), files=files)
 
+    def parse(self, r) -> SauceNaoResult:
         try:
-            rtn = SauceNaoResult(r.json())
-        except requests.exceptions.RequestException:
-            print('\n{ERROR_PROMPT}Invalid result.')
+            response = r.json()
+            rtn = SauceNaoResult(response)
+        except (AttributeError, requests.exceptions.RequestException):
+            log(f'{ERROR_PROMPT}Invalid SauceNao result.')
+            response = {}
             rtn = SauceNaoResult({})
 
-        self.remaining_sauces = int(rtn.header['short_remaining'])
-        self.remaining_sauces_long = int(rtn.header['long_remaining'])
-
+        short_remaining = int(rtn.header['short_remaining'])
+        long_remaining = int(rtn.header['long_remaining'])
+        # SauceNao reports its limits in the body rather than in headers
+        self.session.limiter.observe(self.ENDPOINT, 'short', short_remaining, 30)
+        self.session.limiter.observe(self.ENDPOINT, 'long', long_remaining, 24 * 3600)
+        if self.quota is not None and 'long_remaining' in response.get('header', {}):
+            self.quota.observe(long_remaining, int(rtn.header.get('long_limit') or 0))
+
+        if r is not None and r.status_code == 429:
+            # The image waits in the queue for whichever limit it hit
+            bucket = 'daily' if long_remaining <= 0 else 'short'
+            if bucket == 'short':
+                # Refused before it counted against the day
+                self.refund()
+            reset_in = self.quota.reset_in() if self.quota is not None and bucket == 'daily' else 30
+            raise RateLimitExceeded(self.session.limiter.host(self.ENDPOINT), bucket, reset_in)
+
+        metrics.count('saucenao_searches_total', result='found' if rtn.results else 'empty')
         return rtn
+
+
+class SauceNaoResolver:
+    """
+    Turns a reverse search into a Post.
+    Results from booru indexes name the characters and material themselves, so a post is built straight from those.
+    Only when no close result has them is a post looked up by one of the ids the results carry.
+    """
+    SIMILARITY = 90.0
+
+    def __init__(self, lookups: dict = None, min_similarity: float = SIMILARITY):
+        # Result data key holding a post id -> function returning the Post for that id
+        self.lookups = lookups or {}
+        self.min_similarity = min_similarity
+
+    def matches(self, response: SauceNaoResult) -> list:
+        """
+        Results at least min_similarity alike, closest first.
+        """
+        matches = []
+        for header, data in response.results:
+            try:
+                similarity = float(header.get('similarity', 0))
+            except (TypeError, ValueError):
+                continue
+            if similarity >= self.min_similarity:
+                matches.append((similarity, data))
+        matches.sort(key=lambda i: i[0], reverse=True)
+        return [data for _, data in matches]
+
+    @staticmethod
+    def tags(value) -> list:
+        # SauceNao spells tags as names, "hakurei reimu, kirisame marisa", Danbooru as hakurei_reimu
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = value.split(',')
+        return [i.strip().lower().replace(' ', '_') for i in value if i and i.strip()]
+
+    def from_data(self, data: dict, md5: str) -> Post:
+        characters = self.tags(data.get('characters'))
+        copyrights = self.tags(data.get('material'))
+        if not characters and not copyrights:
+            return None
+        return Post.from_dict({
+            'id': data.get('danbooru_id'),
+            'md5': md5,
+            'tag_string_character': ' '.join(characters),
+            'tag_count_character': len(characters),
+            'tag_string_copyright': ' '.join(copyrights),
+            'tag_count_copyright': len(copyrights),
+        })
+
+    def resolve(self, response: SauceNaoResult, md5: str = None) -> Post:
+        matches = self.matches(response)
+
+        for data in matches:
+            post = self.from_data(data, md5)
+            if post:
+                metrics.count('saucenao_resolved_total', source='data')
+                return post
+
+        for data in matches:
+            for key, lookup in self.lookups.items():
+                if data.get(key):
+                    post = lookup(data[key])
+                    if post:
+                        metrics.count('saucenao_resolved_total', source=key)
+                        return post
+        return None
@@ -0,0 +1,47 @@
+import os
+
+from typing import Iterator
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+class OutputFolders:
+    """
+    Folders created by sorting, remembered so later scans don't pick the sorted images up again.
+    """
+    def __init__(self, database):
+        self.database = database
+        self.database.execute('CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY)')
+        self.paths = {path for path, in self.database.execute('SELECT path FROM folders')}
+
+    def add(self, path: str) -> None:
+        path = os.path.abspath(path)
+        if path not in self.paths:
+            self.paths.add(path)
+            self.database.execute('INSERT OR IGNORE INTO folders VALUES (?)', (path,))
+            self.database.changed()
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self.paths
+
+
+def scan(directory: str, max_depth: int = 0, exclude_names=(), exclude_paths=()) -> Iterator[os.DirEntry]:
+    """
+    Yield image files under directory as they are found, descending at most max_depth folders (negative for no limit).
+    Entries carry the stat data read while listing. Symlinks aren't followed.
+    """
+    stack = [(directory, 0)]
+    while stack:
+        path, depth = stack.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if (max_depth < 0 or depth < max_depth) and entry.name not in exclude_names \
+                                and entry.path not in exclude_paths:
+                            stack.append((entry.path, depth + 1))
+                    elif entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield entry
+        except OSError:
+            continue
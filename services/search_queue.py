@@ -0,0 +1,161 @@
+import collections
+import os
+import threading
+import time
+
+from typing import List
+
+Queued = collections.namedtuple('Queued', 'path md5 root')
+
+
+class Quota:
+    """
+    SauceNao's daily search allowance, kept in sorter.db so a run knows what earlier runs already spent.
+    A search is reserved before it is made, and SauceNao's own count corrects ours whenever it is stricter.
+    The window starts with the first search after the last one ran out.
+    """
+    DAILY = 300
+    WINDOW = 24 * 3600
+
+    def __init__(self, database, daily: int = DAILY):
+        self.database = database
+        self.lock = threading.Lock()
+        self.database.execute('CREATE TABLE IF NOT EXISTS quota ('
+                              'name TEXT PRIMARY KEY, daily INTEGER, remaining INTEGER, reset_at REAL)')
+        rows = self.database.execute("SELECT daily, remaining, reset_at FROM quota WHERE name = 'saucenao'")
+        self.daily, self.remaining, self.reset_at = rows[0] if rows else (daily, daily, 0.0)
+
+    def refresh(self, now: float) -> None:
+        if self.reset_at and now >= self.reset_at:
+            self.remaining = self.daily
+            self.reset_at = 0.0
+
+    def save(self) -> None:
+        self.database.execute("INSERT OR REPLACE INTO quota VALUES ('saucenao', ?, ?, ?)",
+                              (self.daily, self.remaining, self.reset_at))
+        self.database.commit()
+
+    def available(self) -> int:
+        with self.lock:
+            self.refresh(time.time())
+            return max(0, self.remaining)
+
+    def reset_in(self) -> float:
+        """
+        Seconds until the quota is full again, 0 when the window hasn't started.
+        """
+        with self.lock:
+            self.refresh(time.time())
+            return max(0.0, self.reset_at - time.time()) if self.reset_at else 0.0
+
+    def spend(self) -> bool:
+        """
+        Reserve a search. Returns False when none are left in this window.
+        """
+        with self.lock:
+            now = time.time()
+            self.refresh(now)
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            if not self.reset_at:
+                self.reset_at = now + self.WINDOW
+            self.save()
+            return True
+
+    def refund(self) -> None:
+        # The search was reserved but never made
+        with self.lock:
+            self.remaining = min(self.daily, self.remaining + 1)
+            self.save()
+
+    def observe(self, remaining: int, daily: int = None) -> None:
+        """
+        Correct the quota from what SauceNao reported after a search.
+        """
+        with self.lock:
+            if daily:
+                self.daily = daily
+            self.remaining = min(self.remaining, remaining)
+            if not self.reset_at:
+                self.reset_at = time.time() + self.WINDOW
+            self.save()
+
+
+class SearchQueue:
+    """
+    Images waiting for a reverse search, kept in sorter.db until they were searched, in this run or a later one.
+    Handed out best first by priority: newest or oldest, largest or smallest, or by the order the directories were
+    given in. Ties go to the image queued first. Paths and roots are stored absolute, so a run from another directory
+    finds them too.
+    """
+    ORDERS = {
+        'newest': 'mtime DESC',
+        'oldest': 'mtime',
+        'largest': 'size DESC',
+        'smallest': 'size',
+    }
+    PRIORITIES = tuple(ORDERS) + ('directory',)
+
+    def __init__(self, database, priority: str = 'newest'):
+        self.database = database
+        self.priority = priority
+        # Handed out during this run, not handed out again until released
+        self.taken = set()
+        self.database.execute('CREATE TABLE IF NOT EXISTS search_queue ('
+                              'path TEXT PRIMARY KEY, md5 TEXT, root TEXT, size INTEGER, mtime REAL, queued_at REAL)')
+
+    def add(self, path: str, md5: str, root: str) -> None:
+        path, root = os.path.abspath(path), os.path.abspath(root)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        # Queued again by a later run, the image keeps its place
+        self.database.execute('INSERT INTO search_queue VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE '
+                              'SET md5 = excluded.md5, root = excluded.root, size = excluded.size, '
+                              'mtime = excluded.mtime',
+                              (path, md5, root, stat.st_size, stat.st_mtime, time.time()))
+        self.database.changed()
+
+    def remove(self, path: str) -> None:
+        path = os.path.abspath(path)
+        self.database.execute('DELETE FROM search_queue WHERE path = ?', (path,))
+        self.database.changed()
+        self.taken.discard(path)
+
+    def roots(self) -> List[str]:
+        return [i for i, in self.database.execute('SELECT DISTINCT root FROM search_queue ORDER BY root')]
+
+    def count(self, roots: list) -> int:
+        roots = [os.path.abspath(i) for i in roots]
+        marks = ','.join('?' * len(roots))
+        return self.database.execute(f'SELECT COUNT(*) FROM search_queue WHERE root IN ({marks})', roots)[0][0]
+
+    def take(self, n: int, roots: list) -> List[Queued]:
+        """
+        The n best queued images found in roots, leaving out the ones already handed out.
+        """
+        if n <= 0:
+            return []
+
+        roots = [os.path.abspath(i) for i in roots]
+        marks = ','.join('?' * len(roots))
+        params = list(roots)
+        if self.priority == 'directory':
+            order = 'CASE root ' + ' '.join(f'WHEN ? THEN {i}' for i in range(len(roots))) + ' END'
+            params += roots
+        else:
+            order = self.ORDERS[self.priority]
+        rows = self.database.execute(f'SELECT path, md5, root FROM search_queue WHERE root IN ({marks}) '
+                                     f'ORDER BY {order}, queued_at LIMIT ?', params + [n + len(self.taken)])
+
+        queued = [Queued(*i) for i in rows if i[0] not in self.taken][:n]
+        self.taken.update(i.path for i in queued)
+        return queued
+
+    def release(self) -> None:
+        """
+        Let images handed out before but not searched, because the quota ran out, be handed out again.
+        """
+        self.taken.clear()
@@ -0,0 +1,119 @@
+import email.utils
+import random
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .prompts import *
+from .rate_limit import RateLimiter
+
+
+class Session:
+    """
+    Pooled keep-alive HTTP session shared by every service.
+    Failed requests are retried with exponential backoff and full jitter, honouring Retry-After, until either the
+    tries or the total wait budget run out.
+    Every request first waits on the limiter, which raises RateLimitExceeded if the host's limit is far away.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, pool_size: int = 10, tries: int = 10, backoff: float = 1.0, max_backoff: float = 60.0,
+                 max_wait: float = 600.0, timeout: float = 60.0, limiter: RateLimiter = None):
+        self.limiter = limiter or RateLimiter()
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # pool_maxsize is per host, pool_connections is how many hosts keep a pool
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def retry_after(r: requests.Response) -> float:
+        value = r.headers.get('Retry-After') if r is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int, r: requests.Response) -> float:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = self.retry_after(r)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def request(self, method: str, url: str, retry_statuses=None, **kwargs) -> requests.Response:
+        """
+        Returns the first response that doesn't need retrying, the last response once retries run out,
+        or None if the host could never be reached. retry_statuses replaces RETRY_STATUSES for this request.
+        """
+        retry_statuses = self.RETRY_STATUSES if retry_statuses is None else retry_statuses
+        kwargs.setdefault('timeout', self.timeout)
+        host = self.limiter.host(url)
+        waited = 0.0
+        r = None
+        for attempt in range(self.tries):
+            metrics.count('rate_limit_sleep_seconds_total', self.limiter.acquire(url), host=host)
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                r = None
+            metrics.observe('http_request_seconds', time.perf_counter() - start, host=host)
+            metrics.count('http_requests_total', host=host, status=r.status_code if r is not None else 'error')
+
+            if r is not None:
+                self.limiter.update(url, r.headers)
+                if r.status_code not in retry_statuses:
+                    return r
+
+            delay = self.delay(attempt, r)
+            if attempt == self.tries - 1 or waited + delay > self.max_wait:
+                break
+
+            log(f'{ERROR_PROMPT}Request to {url} failed, sleeping for {delay:.0f}s.')
+            metrics.count('http_retries_total', host=host)
+            metrics.count('retry_sleep_seconds_total', delay, host=host)
+            time.sleep(delay)
+            waited += delay
+
+        return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+
+_shared = None
+
+
+def shared() -> Session:
+    global _shared
+    if _shared is None:
+        _shared = Session()
+    return _shared
+
+
+def configure(**kwargs) -> Session:
+    """
+    Replace the shared session, for example to change the pool size.
+    """
+    global _shared
+    _shared = Session(**kwargs)
+    return _shared
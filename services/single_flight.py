@@ -0,0 +1,55 @@
+import concurrent.futures
+import threading
+
+from . import metrics
+
+
+class SingleFlight:
+    """
+    Shares one call per key between everyone asking for it while it runs.
+    Identical images have the same md5, so a lookup, upload or search in flight is made once for all of them.
+    Calls are forgotten once settled, so a run over millions of images doesn't keep a future for each: later
+    callers find successful answers in the caches, failed calls are simply tried again.
+    With keep, settled results are kept for the rest of the run instead, for calls too few to matter and too dear
+    to repeat, like reverse searches.
+    """
+    def __init__(self, kind: str, keep: bool = False):
+        self.kind = kind
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.results = {}
+
+    def claim(self, key) -> tuple:
+        """
+        Returns (future, True) when the caller has to make the call and settle the future, (future, False) when
+        another caller already does or did.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            if future is None and key in self.results:
+                future = concurrent.futures.Future()
+                future.set_result(self.results[key])
+            if future is not None:
+                metrics.count('coalesced_total', kind=self.kind)
+                return future, False
+            future = self.calls[key] = concurrent.futures.Future()
+            return future, True
+
+    def settle(self, key, future: concurrent.futures.Future, result) -> None:
+        with self.lock:
+            if self.forget(key, future) and self.keep:
+                self.results[key] = result
+        future.set_result(result)
+
+    def fail(self, key, future: concurrent.futures.Future, exception: BaseException) -> None:
+        with self.lock:
+            self.forget(key, future)
+        future.set_exception(exception)
+
+    def forget(self, key, future: concurrent.futures.Future) -> bool:
+        # Called with the lock held
+        if self.calls.get(key) is future:
+            del self.calls[key]
+            return True
+        return False
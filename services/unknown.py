@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+
+
+class UnknownJournal:
+    """
+    Append-only record of files that couldn't be identified, one "md5<TAB>time<TAB>path" line each.
+    Entries are indexed by both path and content hash, so a renamed unknown file is still skipped, until they are
+    older than ttl seconds and the file is looked up again.
+    A line torn by a crash is dropped on the next load. Expired entries are left out when loading, and the file is
+    rewritten without them once they, and lines added again after expiring, make up most of it.
+    """
+    PATH = 'unknown.journal'
+    # Old format, a full list of paths rewritten on every miss
+    LEGACY_PATH = 'unknown.txt'
+    NO_MD5 = '-'
+
+    def __init__(self, path: str = None, ttl: float = None):
+        self.path = path or self.PATH
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Keyed on path, md5 and both, with the time the newest entry was added
+        self.paths = {}
+        self.md5s = {}
+        self.entries = {}
+        self.lines = 0
+
+        self.load()
+        if os.path.exists(self.LEGACY_PATH):
+            self.migrate()
+        if self.lines > 2 * len(self.entries) + 1000:
+            self.compact()
+
+        self.file_ = open(self.path, 'a', encoding='utf-8')
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as file_:
+            data = file_.read()
+
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            # Drop the half-written last line left by a crash
+            with open(self.path, 'r+b') as file_:
+                file_.truncate(end)
+
+        for line in data[:end].decode('utf-8', 'replace').splitlines():
+            fields = line.split('\t', 2)
+            if len(fields) == 3:
+                md5, added, path = fields
+                try:
+                    added = float(added)
+                except ValueError:
+                    added = None
+                if self.fresh(added):
+                    self.index(md5, path, added)
+            self.lines += 1
+
+    def migrate(self) -> None:
+        with open(self.LEGACY_PATH, encoding='utf-8') as file_:
+            paths = [i for i in file_.read().split('\n') if i]
+
+        now = int(time.time())
+        with open(self.path, 'a', encoding='utf-8') as file_:
+            for path in paths:
+                if path not in self.paths:
+                    file_.write(f'{self.NO_MD5}\t{now}\t{path}\n')
+                    self.index(self.NO_MD5, path, now)
+                    self.lines += 1
+            file_.flush()
+            os.fsync(file_.fileno())
+
+        os.replace(self.LEGACY_PATH, self.LEGACY_PATH + '.old')
+
+    def compact(self) -> None:
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as file_:
+            for (md5, path), added in sorted(self.entries.items()):
+                file_.write(f'{md5}\t{added:.0f}\t{path}\n')
+            file_.flush()
+            os.fsync(file_.fileno())
+
+        os.replace(temp, self.path)
+        self.lines = len(self.entries)
+
+    def index(self, md5: str, path: str, added: float) -> None:
+        self.entries[md5, path] = max(added, self.entries.get((md5, path), added))
+        self.paths[path] = max(added, self.paths.get(path, added))
+        if md5 != self.NO_MD5:
+            self.md5s[md5] = max(added, self.md5s.get(md5, added))
+
+    def fresh(self, added: float) -> bool:
+        return added is not None and (self.ttl is None or time.time() - added < self.ttl)
+
+    def __contains__(self, path: str) -> bool:
+        return self.fresh(self.paths.get(path))
+
+    def has_md5(self, md5: str) -> bool:
+        return self.fresh(self.md5s.get(md5))
+
+    def add(self, path: str, md5: str = None) -> None:
+        md5 = md5 or self.NO_MD5
+        with self.lock:
+            if self.fresh(self.entries.get((md5, path))):
+                return
+
+            now = int(time.time())
+            self.file_.write(f'{md5}\t{now}\t{path}\n')
+            self.file_.flush()
+            os.fsync(self.file_.fileno())
+            self.index(md5, path, now)
+            self.lines += 1
+
+    def close(self) -> None:
+        with self.lock:
+            self.file_.close()
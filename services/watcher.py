@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from typing import Iterator, List
+
+from .scanner import IMAGE_EXTENSIONS, scan
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie, name length, followed by the name
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Minimal inotify binding over ctypes. Raises OSError where inotify isn't available.
+    """
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available')
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add(self, path: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+
+    def read(self, timeout: float = None) -> list:
+        """
+        Wait up to timeout seconds (forever if None) for events. Returns a list of (path, mask).
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+
+            if mask & IN_IGNORED:
+                # The watched folder was removed
+                self.watches.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self.watches:
+                events.append((os.path.join(self.watches[wd], os.fsdecode(name)), mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Yields lists of image files that appeared in the directories, once they stopped changing.
+    A file counts as settled when its size and modification time stay the same for settle seconds, so downloads
+    still being written are left alone. Uses inotify where available and polls every poll_interval seconds otherwise.
+    Waits without a timeout while nothing is pending, so an idle watcher costs no CPU.
+    """
+    def __init__(self, directories: list, max_depth: int = 0, exclude_names=(), exclude_paths=(),
+                 settle: float = 1.0, poll_interval: float = 2.0):
+        self.directories = directories
+        self.max_depth = max_depth
+        self.exclude_names = exclude_names
+        self.exclude_paths = exclude_paths
+        self.settle = settle
+        self.poll_interval = poll_interval
+        # path -> [deadline, (size, mtime) at the last check]
+        self.pending = {}
+        self.depths = {}
+
+        try:
+            self.inotify = Inotify()
+            for directory in directories:
+                self.watch(directory, 0)
+        except OSError:
+            self.inotify = None
+            self.seen = self.snapshot()
+
+    @property
+    def polling(self) -> bool:
+        return self.inotify is None
+
+    def watch(self, directory: str, depth: int) -> None:
+        self.inotify.add(directory)
+        self.depths[directory] = depth
+        if self.max_depth >= 0 and depth >= self.max_depth:
+            return
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and not self.excluded(entry.path):
+                        self.watch(entry.path, depth + 1)
+        except OSError:
+            pass
+
+    def excluded(self, path: str) -> bool:
+        if os.path.basename(path) in self.exclude_names:
+            return True
+        while path not in self.directories:
+            if path in self.exclude_paths:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return False
+
+    def snapshot(self) -> dict:
+        files = {}
+        for directory in self.directories:
+            for entry in scan(directory, self.max_depth, self.exclude_names, self.exclude_paths):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files[entry.path] = stat.st_size, stat.st_mtime_ns
+        return files
+
+    def __iter__(self) -> Iterator[List[str]]:
+        while True:
+            files = self.poll() if self.polling else self.wait()
+            if files:
+                yield files
+
+    def schedule(self, path: str) -> None:
+        if path in self.pending:
+            self.pending[path][0] = time.monotonic() + self.settle
+        else:
+            self.pending[path] = [time.monotonic() + self.settle, None]
+
+    def wait(self) -> List[str]:
+        timeout = None
+        if self.pending:
+            timeout = max(0.0, min(deadline for deadline, _ in self.pending.values()) - time.monotonic())
+
+        for path, mask in self.inotify.read(timeout):
+            if path is None:
+                # Events were dropped, fall back to a listing to catch up
+                for directory in self.directories:
+                    for entry in scan(directory, self.max_depth, self.exclude_names, self.exclude_paths):
+                        self.schedule(entry.path)
+            elif mask & IN_ISDIR:
+                depth = self.depths.get(os.path.dirname(path), 0) + 1
+                if mask & (IN_CREATE | IN_MOVED_TO) and (self.max_depth < 0 or depth <= self.max_depth) \
+                        and not self.excluded(path):
+                    self.watch(path, depth)
+                    # A folder moved in arrives with its files, no events come for those
+                    remaining = self.max_depth - depth if self.max_depth >= 0 else -1
+                    for entry in scan(path, remaining, self.exclude_names, self.exclude_paths):
+                        self.schedule(entry.path)
+            elif path.lower().endswith(IMAGE_EXTENSIONS) and not self.excluded(os.path.dirname(path)):
+                self.schedule(path)
+
+        return self.settled()
+
+    def settled(self) -> List[str]:
+        now = time.monotonic()
+        files = []
+        for path, (deadline, last) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            current = stat.st_size, stat.st_mtime_ns
+            if current == last:
+                del self.pending[path]
+                files.append(path)
+            else:
+                # Changed since the last look, or not looked at yet
+                self.pending[path] = [now + self.settle, current]
+        return files
+
+    def poll(self) -> List[str]:
+        time.sleep(self.poll_interval)
+        seen = self.snapshot()
+        files = []
+        for path, current in seen.items():
+            # New or changed files are reported once a listing finds them unchanged
+            if self.seen.get(path) != current:
+                self.pending[path] = [0.0, current]
+            elif path in self.pending and self.pending[path][1] == current:
+                del self.pending[path]
+                files.append(path)
+        for path in list(self.pending):
+            if path not in seen:
+                del self.pending[path]
+        self.seen = seen
+        return files
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
@@ -0,0 +1,91 @@
+import time
+import unittest
+
+from services.booru import Booru
+
+
+class Stub:
+    """
+    A booru answering after delay with the posts it knows, or failing like an unreachable one.
+    """
+    MIRROR = None
+
+    def __init__(self, name: str, posts: dict = None, delay: float = 0.0, fails: bool = False, mirror: str = None):
+        self.NAME = name
+        self.MIRROR = mirror
+        self.posts = posts or {}
+        self.delay = delay
+        self.fails = fails
+        self.asked = None
+
+    def get_from_md5_many(self, md5s: list) -> dict:
+        self.asked = time.monotonic()
+        time.sleep(self.delay)
+        if self.fails:
+            return None
+        return {i: self.posts[i] for i in md5s if i in self.posts}
+
+
+class LookupTest(unittest.TestCase):
+    def booru(self, *providers) -> Booru:
+        booru = Booru(providers=[i.NAME for i in providers])
+        self.addCleanup(booru.close)
+        booru.providers = list(providers)
+        booru.by_name = {i.NAME: i for i in providers}
+        booru.HEDGE_AFTER = 0.1
+        booru.MIN_HEDGE_AFTER = 0.1
+        return booru
+
+    def test_misses_fall_through_but_not_to_a_mirror(self):
+        danbooru = Stub('danbooru', {'a': 1})
+        safebooru = Stub('safebooru', {'a': 1, 'b': 2}, mirror='danbooru')
+        gelbooru = Stub('gelbooru', {'c': 3})
+        found, missing = self.booru(danbooru, safebooru, gelbooru).lookup(['a', 'b', 'c', 'd'])
+
+        self.assertEqual(found, {'a': 1, 'c': 3})
+        self.assertEqual(missing, {'b', 'd'})
+        self.assertIsNone(safebooru.asked)
+
+    def test_mirror_asked_when_the_original_fails(self):
+        danbooru = Stub('danbooru', fails=True)
+        safebooru = Stub('safebooru', {'a': 1}, mirror='danbooru')
+        found, missing = self.booru(danbooru, safebooru).lookup(['a', 'b'])
+
+        self.assertEqual(found, {'a': 1})
+        # The mirror can't tell what the original would have had
+        self.assertEqual(missing, set())
+
+    def test_hedge_hits_are_handed_on_before_the_slow_booru_answers(self):
+        danbooru = Stub('danbooru', {'a': 1, 'b': 2}, delay=0.5)
+        safebooru = Stub('safebooru', {'a': 1}, mirror='danbooru')
+        arrived = {}
+        start = time.monotonic()
+        found, missing = self.booru(danbooru, safebooru).lookup(
+            ['a', 'b', 'c'], lambda md5, post: arrived.setdefault(md5, time.monotonic() - start))
+
+        self.assertEqual(found, {'a': 1, 'b': 2})
+        self.assertEqual(missing, {'c'})
+        self.assertLess(arrived['a'], 0.4)
+        self.assertGreaterEqual(arrived['b'], 0.5)
+
+    def test_each_hedge_waits_its_own_deadline(self):
+        danbooru = Stub('danbooru', {'a': 1}, delay=0.6)
+        safebooru = Stub('safebooru', delay=0.6, mirror='danbooru')
+        gelbooru = Stub('gelbooru', {'a': 1})
+        self.booru(danbooru, safebooru, gelbooru).lookup(['a'])
+
+        self.assertGreaterEqual(safebooru.asked - danbooru.asked, 0.09)
+        self.assertGreaterEqual(gelbooru.asked - safebooru.asked, 0.09)
+
+    def test_answers_from_a_mirror_are_dropped_once_the_original_answered(self):
+        danbooru = Stub('danbooru', {'a': 1}, delay=0.2)
+        safebooru = Stub('safebooru', delay=2.0, mirror='danbooru')
+        start = time.monotonic()
+        found, missing = self.booru(danbooru, safebooru).lookup(['a', 'b'])
+
+        self.assertEqual((found, missing), ({'a': 1}, {'b'}))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+
+from services.dump_index import DumpIndex
+
+
+def md5(n: int) -> str:
+    return hashlib.md5(str(n).encode()).hexdigest()
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def dump(self, name: str, posts: dict) -> str:
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file_:
+            for n, id_ in posts.items():
+                file_.write(json.dumps({'id': id_, 'md5': md5(n), 'rating': 's'}) + '\n')
+        return path
+
+    def test_newest_post_wins_after_compacting(self):
+        index = DumpIndex(os.path.join(self.directory.name, 'index'))
+        index.import_dump(self.dump('d1.jsonl', {n: n for n in range(10)}))
+        index.import_dump(self.dump('d2.jsonl', {5: 500, 10: 10}))
+        self.assertEqual(index.get(md5(5)).id, 500)
+
+        self.assertEqual(index.compact(), 11)
+        self.assertEqual(len(index.segments), 1)
+        self.assertEqual(index.get(md5(5)).id, 500)
+        self.assertEqual(index.get(md5(4)).id, 4)
+        self.assertEqual(index.get(md5(10)).id, 10)
+
+        # Still the newest once read back from disk
+        reopened = DumpIndex(index.path)
+        self.assertEqual(reopened.get(md5(5)).id, 500)
+        for segment in index.segments + reopened.segments:
+            segment.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
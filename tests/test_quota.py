@@ -0,0 +1,109 @@
+import os
+import tempfile
+import time
+import unittest
+
+from services.database import Database
+from services.rate_limit import RateLimitExceeded
+from services.sauce_nao import SauceNao
+from services.search_queue import Quota, SearchQueue
+
+
+class Limiter:
+    def observe(self, *args):
+        pass
+
+    @staticmethod
+    def host(url):
+        return 'saucenao.com'
+
+
+class Session:
+    limiter = Limiter()
+
+
+class Response:
+    def __init__(self, status_code: int, header: dict):
+        self.status_code = status_code
+        self.body = {'header': header, 'results': []}
+
+    def json(self):
+        return self.body
+
+
+class QuotaTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = Database(os.path.join(directory.name, 'sorter.db'))
+        self.addCleanup(self.database.close)
+        self.quota = Quota(self.database, daily=3)
+        # Without reading an API key from keys/
+        self.sauce_nao = SauceNao.__new__(SauceNao)
+        self.sauce_nao.session = Session()
+        self.sauce_nao.quota = self.quota
+
+    def test_spent_until_the_window_resets(self):
+        self.assertTrue(all(self.quota.spend() for _ in range(3)))
+        self.assertFalse(self.quota.spend())
+        self.assertGreater(self.quota.reset_in(), 0)
+        # Kept for the next run
+        self.assertEqual(Quota(self.database).available(), 0)
+
+        self.quota.reset_at = time.time() - 1
+        self.assertEqual(self.quota.available(), 3)
+
+    def test_short_limit_429_is_refunded(self):
+        self.sauce_nao.reserve()
+        with self.assertRaises(RateLimitExceeded) as raised:
+            self.sauce_nao.parse(Response(429, {'short_remaining': 0, 'long_remaining': 3, 'long_limit': 3}))
+        self.assertEqual(raised.exception.bucket, 'short')
+        self.assertEqual(self.quota.available(), 3)
+
+    def test_daily_limit_429_is_not_refunded(self):
+        self.sauce_nao.reserve()
+        with self.assertRaises(RateLimitExceeded) as raised:
+            self.sauce_nao.parse(Response(429, {'short_remaining': 20, 'long_remaining': 0, 'long_limit': 3}))
+        self.assertEqual(raised.exception.bucket, 'daily')
+        self.assertEqual(self.quota.available(), 0)
+        with self.assertRaises(RateLimitExceeded):
+            self.sauce_nao.reserve()
+
+    def test_answered_search_corrects_the_quota(self):
+        self.sauce_nao.reserve()
+        self.sauce_nao.parse(Response(200, {'short_remaining': 20, 'long_remaining': 1, 'long_limit': 3}))
+        self.assertEqual(self.quota.available(), 1)
+
+
+class SearchQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.database = Database(os.path.join(self.root, 'sorter.db'))
+        self.addCleanup(self.database.close)
+        self.queue = SearchQueue(self.database, 'largest')
+
+        for name, size in (('small.jpg', 10), ('large.jpg', 30), ('medium.jpg', 20)):
+            path = os.path.join(self.root, name)
+            with open(path, 'wb') as file_:
+                file_.write(b'x' * size)
+            self.queue.add(os.path.relpath(path), name, os.path.relpath(self.root))
+
+    def test_taken_best_first_and_not_handed_out_twice(self):
+        taken = self.queue.take(2, [self.root])
+        self.assertEqual([i.md5 for i in taken], ['large.jpg', 'medium.jpg'])
+        self.assertEqual([i.md5 for i in self.queue.take(2, [self.root])], ['small.jpg'])
+
+        self.queue.release()
+        self.queue.remove(taken[0].path)
+        self.assertEqual(self.queue.count([self.root]), 2)
+        self.assertEqual([i.md5 for i in self.queue.take(5, [self.root])], ['medium.jpg', 'small.jpg'])
+
+    def test_stored_absolute(self):
+        self.assertEqual(self.queue.roots(), [os.path.abspath(self.root)])
+        self.assertTrue(all(os.path.isabs(i.path) for i in self.queue.take(5, [os.path.relpath(self.root)])))
+
+
+if __name__ == '__main__':
+    unittest.main()
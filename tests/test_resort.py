@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+from main import Program
+from services import file_ops
+from services.database import Database
+from services.hash_cache import HashCache
+from services.manifest import Manifest
+from services.post import Post
+from services.scanner import OutputFolders
+
+
+class ResortTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = os.path.join(os.path.realpath(self.directory.name), 'images')
+        os.mkdir(self.root)
+        self.database = Database(os.path.join(self.directory.name, 'sorter.db'))
+        self.addCleanup(self.database.connection.close)
+
+        # Only what resort touches, without parsing arguments or asking for settings
+        self.program = Program.__new__(Program)
+        self.program.base_directories = [self.root]
+        self.program.file_workers = 2
+        self.program.dry_run = False
+        self.program.database = self.database
+        self.program.manifest = Manifest(self.database)
+        self.program.hash_cache = HashCache(self.database)
+        self.program.output_folders = OutputFolders(self.database)
+        self.program.claims = {}
+        self.program.claims_lock = threading.Lock()
+
+        # Entries as found but never sorted, so the first resort lays them out like a first run would
+        self.image('a.jpg', 'alice', 'series_a')
+        self.image('b.jpg', 'bob carol', 'series_a series_b')
+
+    def image(self, name: str, characters: str, copy_rights: str) -> None:
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as file_:
+            file_.write(name)
+        md5 = hashlib.md5(name.encode()).hexdigest()
+        post = Post(1, md5, characters, len(characters.split()), copy_rights, len(copy_rights.split()), 's')
+        self.program.manifest.put(self.root, name, md5, post, path, [], path)
+
+    def resort(self, sort_by: str, multiple_operation: str, file_operation: str) -> None:
+        self.program.sort_by = sort_by
+        self.program.multiple_operation = multiple_operation
+        self.program.file_operation = file_operation
+        self.program.resort()
+
+    def layout(self) -> dict:
+        files = {}
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(folder, name)
+                files[os.path.relpath(path, self.root)] = 'link' if os.path.islink(path) else 'file'
+        return files
+
+    def test_second_resort_changes_nothing(self):
+        self.resort(Program.SERIES, Program.FIRST, Program.MOVE)
+        layout = self.layout()
+        self.assertEqual(layout, {os.path.join('series_a', 'a.jpg'): 'file',
+                                  os.path.join('series_a', 'b.jpg'): 'file'})
+
+        planned = [self.program.plan_resort(i) for i in self.program.manifest.entries(self.root)]
+        self.assertEqual([[op for op in i[0] if op.kind != file_ops.MKDIR] for i in planned], [[], []])
+        self.resort(Program.SERIES, Program.FIRST, Program.MOVE)
+        self.assertEqual(self.layout(), layout)
+
+    def test_switching_layouts(self):
+        self.resort(Program.SERIES, Program.FIRST, Program.MOVE)
+        self.resort(Program.CHARACTER, Program.FIRST, Program.MOVE)
+        self.assertEqual(self.layout(), {os.path.join('alice', 'a.jpg'): 'file',
+                                         os.path.join('bob', 'b.jpg'): 'file'})
+
+        self.resort(Program.CHARACTER, Program.COPIES, Program.COPY)
+        self.assertEqual(self.layout(), {os.path.join('.images', 'a.jpg'): 'file',
+                                         os.path.join('.images', 'b.jpg'): 'file',
+                                         os.path.join('alice', 'a.jpg'): 'link',
+                                         os.path.join('bob', 'b.jpg'): 'link',
+                                         os.path.join('carol', 'b.jpg'): 'link'})
+        with open(os.path.join(self.root, 'carol', 'b.jpg')) as file_:
+            self.assertEqual(file_.read(), 'b.jpg')
+
+        # Back to where the images were found once nothing sorts them
+        self.resort(Program.SERIES, Program.FIRST, Program.MOVE)
+        self.program.sort_by = Program.CHARACTER
+        self.program.relevant = lambda b_image: False
+        self.program.resort()
+        self.assertEqual(self.layout(), {'a.jpg': 'file', 'b.jpg': 'file'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from main import Program
+from services.single_flight import SingleFlight
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def put(self, item):
+        self.calls.append(item)
+
+    def remove(self, path):
+        self.calls.append(path)
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        # Only what search_file touches, without parsing arguments or opening sorter.db
+        self.program = Program.__new__(Program)
+        self.program.searches = SingleFlight('search', keep=True)
+        self.program.search_queue = Recorder()
+        self.program.file_stage = Recorder()
+        self.program.image_host = None
+        self.program.direct_search = True
+        self.searched = []
+
+        def reverse_search(file_, md5):
+            self.searched.append(file_)
+            return None
+        self.program.reverse_search = reverse_search
+
+    def test_identical_images_searched_one_after_the_other_share_the_search(self):
+        self.program.search_file(('a.jpg', 'ab' * 16))
+        self.program.search_file(('b.jpg', 'ab' * 16))
+        self.program.search_file(('c.jpg', 'cd' * 16))
+
+        self.assertEqual(self.searched, ['a.jpg', 'c.jpg'])
+        self.assertEqual(self.program.file_stage.calls,
+                         [('a.jpg', 'ab' * 16, None), ('b.jpg', 'ab' * 16, None), ('c.jpg', 'cd' * 16, None)])
+        self.assertEqual(self.program.search_queue.calls, ['a.jpg', 'b.jpg', 'c.jpg'])
+
+    def test_failed_searches_are_tried_again(self):
+        def failing(file_, md5):
+            self.searched.append(file_)
+            raise OSError('upload failed')
+        self.program.reverse_search = failing
+
+        for file_ in ('a.jpg', 'b.jpg'):
+            with self.assertRaises(OSError):
+                self.program.search_file((file_, 'ab' * 16))
+        self.assertEqual(self.searched, ['a.jpg', 'b.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
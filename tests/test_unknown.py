@@ -0,0 +1,52 @@
+import os
+import tempfile
+import time
+import unittest
+
+from services.unknown import UnknownJournal
+
+
+class UnknownJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'unknown.journal')
+
+    def open(self, ttl: float = None) -> UnknownJournal:
+        journal = UnknownJournal(self.path, ttl)
+        self.addCleanup(journal.close)
+        return journal
+
+    def lines(self) -> list:
+        with open(self.path, encoding='utf-8') as file_:
+            return file_.read().splitlines()
+
+    def test_skipped_by_path_and_md5(self):
+        self.open().add('a.jpg', 'aa')
+        journal = self.open()
+        self.assertIn('a.jpg', journal)
+        self.assertTrue(journal.has_md5('aa'))
+        self.assertNotIn('b.jpg', journal)
+
+    def test_expired_entries_are_looked_up_again_and_compacted_away(self):
+        old = time.time() - 3600
+        with open(self.path, 'w', encoding='utf-8') as file_:
+            for n in range(2000):
+                file_.write(f'{n:032x}\t{old:.0f}\t{n}.jpg\n')
+            file_.write(f'{"f" * 32}\t{time.time():.0f}\tnew.jpg\n')
+            # Torn by a crash
+            file_.write(f'{"e" * 32}\t')
+
+        journal = self.open(ttl=60)
+        self.assertNotIn('0.jpg', journal)
+        self.assertFalse(journal.has_md5(f'{0:032x}'))
+        self.assertIn('new.jpg', journal)
+        self.assertEqual(len(self.lines()), 1)
+
+        journal.add('0.jpg', f'{0:032x}')
+        self.assertIn('0.jpg', journal)
+        self.assertEqual(len(self.lines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()